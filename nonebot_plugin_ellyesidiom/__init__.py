@@ -13,19 +13,28 @@ from .tools import hash_extender, hash_shortener
 from .tools import get_card_with_cache
 from .tools import ei_argparser
 from .tools import check_dedup
+from .tools import delete_idioms
 from .tools import xxh3_64_hexdigest
 from .tools import client
 from .data_es import update_ocr_text as es_update_ocr_text, add_tags_by_hash as es_add_tags_by_hash, delete_idiom_by_image_hash as es_delete_idiom_by_image_hash, update_under_review_by_hash as es_update_review_status
-from .data_mongo import delete_idiom_by_image_hash, edit_catalogue_by_image_hash, edit_comment_by_image_hash, edit_tags_by_hash, get_ext_by_image_hash, get_review_status_by_image_hash, get_under_review_idioms, get_uploader_by_hash, greylist_incr, update_ocr_text_by_image_hash, update_review_status_by_image_hash
+from .data_es import refresh_es_index, edit_tags_by_hash as es_edit_tags_by_hash, edit_catalogue_by_hash as es_edit_catalogue_by_hash, edit_comment_by_hash as es_edit_comment_by_hash
+from .data_mongo import delete_idiom_by_image_hash, edit_catalogue_by_image_hash, edit_comment_by_image_hash, edit_tags_by_hash, get_ext_by_image_hash, get_under_review_idioms, greylist_incr, update_ocr_text_by_image_hash, update_review_status_by_image_hash
 from .data_mongo import count_under_review, count_reviewed
 from .data_mongo import add_tags_by_hash
 from .data_mongo import get_uploader_rank
-from .data_mongo import get_random_idiom
-from .data_mongo import add_cate as mg_add_cate, append_cate as mg_append_cate, get_all_alias
-from .data_mongo import idioms_data
-from .data_redis import get_ratelimited, set_ratelimited, set_group_name
-from .storage import ei_img_storage_delete, ei_img_storage_download
-from .ocr import get_ocr_text_cloud, clean_ocr_text_pure_str
+from .random_deck import draw_random_idiom
+from .cat_checker import add_cate as add_cate_alias, append_cate as append_cate_alias, get_alias_table
+from .data_mongo import ensure_indexes, check_query_plans
+from .data_mongo import IdiomRepository
+from .data_redis import get_ratelimited, set_ratelimited, set_group_name, get_refilter_checkpoint
+from .ocr_refilter import start_ocr_refilter, refilter_running, format_refilter_progress, default_refilter_match, interrupted_refilter_match
+from . import phash_backfill
+from .storage import ei_img_storage_delete_many, ei_img_storage_download
+from .thumbnail import thumbnail_keys, forget_thumbnails
+from .cache import get_cache_stats
+from .query_cache import get_query_cache_stats
+from .prefetch import last_prefetch_report
+from .ocr import get_ocr_text_cloud
 from .eh_server import *
 from .consts import tips_no_permission
 
@@ -43,6 +52,8 @@ search = on_command("查询", rule=to_me())
 delete = on_command("删除", rule=to_me())
 statistics = on_command("统计", rule=to_me())
 rank = on_command("排行", rule=to_me())
+cache_statistics = on_command("缓存统计", rule=to_me())
+index_check = on_command("索引检查", rule=to_me())
 edit = on_command("编辑", rule=to_me())
 
 random_idiom_poke = on_notice(rule=_poke_checker)
@@ -161,7 +172,8 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     for filename in filelist:
         with open(os.path.join(bulk_dir, filename), "rb") as f:
             image_content = f.read()
-        await upload_image(bulk_upload, [image_content], [], {"nickname": "欧式查理", "id": "269077688", "platform": "导入"}, False, [], [])
+        await upload_image(bulk_upload, [image_content], [], {"nickname": "欧式查理", "id": "269077688", "platform": "导入"}, False, [], [], es_refresh=False)
+    await refresh_es_index()
 
 
 @update_ocr.handle()
@@ -179,17 +191,24 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
 
 @refilting_ocr.handle()
 async def _(bot: Bot, event: Event, args: Message = CommandArg()):
-    all_idioms = idioms_data.find()
-    count = 0
-    for idiom in all_idioms:
-        ocr_text = idiom["ocr_text"]
-        if "怡春院" not in str(ocr_text):
-            continue
-        new_ocr_text = await clean_ocr_text_pure_str(ocr_text)
-        await update_ocr_text_by_image_hash(idiom["image_hash"], new_ocr_text)
-        await es_update_ocr_text(idiom["image_hash"], new_ocr_text)
-        print(f"processed {count} documents")
-        count += 1
+    if event.get_user_id() not in ei_upload_whitelist:
+        await refilting_ocr.finish(tips_no_permission)
+    if refilter_running():
+        await refilting_ocr.finish(format_refilter_progress())
+
+    async def report(msg: str):
+        await bot.send(event, msg)
+
+    resumed = get_refilter_checkpoint() is not None
+    if resumed:
+        # an interrupted run keeps the scope it was started with
+        match = interrupted_refilter_match()
+    else:
+        # 重过滤ocr 全部 re-filters every idiom with the current blacklist, not just the 怡春院 ones
+        match = None if str(args).strip() == "全部" else default_refilter_match
+    start_ocr_refilter(report, match)
+    scope = "全部怡言" if match is None else f"含“{match}”的怡言"
+    await refilting_ocr.finish(f"从断点继续重过滤OCR（{scope}）。" if resumed else f"开始重过滤OCR（{scope}）。")
 
 
 @get_ocr_result.handle()
@@ -211,30 +230,23 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
         await delete.finish(tips_no_permission)
     if len(args) == 0:
         await delete.finish("请输入要删除的ID。")
-    image_hashes = str(args)
-    image_hashes = image_hashes.split(" ")
+    image_hashes = str(args).split()
+    report = await delete_idioms(image_hashes)
     result_text = ""
-    for image_hash in image_hashes:
-        temp_result_text = ""
-
-        image_hash = await hash_extender(image_hash, event.group_id)
-        image_ext = await get_ext_by_image_hash(image_hash)
-        if not image_ext:
-            temp_result_text += f"未找到ID为{await hash_shortener(image_hash)}的图片。\n"
-        else:
-            await ei_img_storage_delete(f"{image_hash}.{image_ext}")
-
-        try:
-            await delete_idiom_by_image_hash(image_hash)
-            await es_delete_idiom_by_image_hash(image_hash)
-        except IndexError:
-            if temp_result_text == "":
-                temp_result_text += f"未找到ID为{await hash_shortener(image_hash)}的记录。\n"
-            else:
-                temp_result_text = f"未找到ID为{await hash_shortener(image_hash)}的图片与记录。\n"
-        result_text += temp_result_text
-    await delete.send(result_text)
-    await delete.finish("已全部删除。")
+    deleted_count = 0
+    for image_id, outcome in report.items():
+        match outcome["status"]:
+            case "not_found":
+                result_text += f"未找到ID为{image_id.upper()}的记录。\n"
+            case "conflict":
+                result_text += f"ID {image_id.upper()} 对应多条记录，未删除。可选ID:\n" + "\n".join(outcome["candidates"]) + "\n"
+            case "storage_failed":
+                result_text += f"ID为{await hash_shortener(outcome['image_hash'])}的图片删除失败，记录已删除。\n"
+                deleted_count += 1
+            case _:
+                deleted_count += 1
+    result_text += f"已删除{deleted_count}条记录。"
+    await delete.finish(result_text)
 
 
 @statistics.handle()
@@ -244,10 +256,51 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     await statistics.finish(f"待审核：{result_under_review}\n已审核：{result_reviewed}")
 
 
+@cache_statistics.handle()
+async def _(bot: Bot, event: Event, args: Message = CommandArg()):
+    if event.get_user_id() not in ei_upload_whitelist:
+        await cache_statistics.finish(tips_no_permission)
+    stats = get_cache_stats()
+    msg = f"缓存文件：{stats['files']}\n"
+    msg += f"占用：{stats['bytes'] / 1024 / 1024:.1f}MB / {stats['max_bytes'] / 1024 / 1024:.1f}MB\n"
+    msg += f"命中：{stats['hits']} 未命中：{stats['misses']} 命中率：{stats['hit_ratio']:.1%}\n"
+    msg += f"淘汰：{stats['evictions']}"
+    query_stats = get_query_cache_stats()
+    msg += f"\n查询缓存：{query_stats['entries']}/{query_stats['max_entries']}条 命中：{query_stats['hits']} 未命中：{query_stats['misses']} 命中率：{query_stats['hit_ratio']:.1%} 失效：{query_stats['invalidations']}次"
+    if last_prefetch_report:
+        msg += f"\n上次预热：{last_prefetch_report['warmed']}张，{last_prefetch_report['bytes'] / 1024 / 1024:.1f}MB，耗时{last_prefetch_report['elapsed']:.1f}秒"
+    await cache_statistics.finish(msg)
+
+
+@index_check.handle()
+async def _(bot: Bot, event: Event, args: Message = CommandArg()):
+    if event.get_user_id() not in ei_upload_whitelist:
+        await index_check.finish(tips_no_permission)
+    report = await ensure_indexes()
+    plans = await check_query_plans()
+    msg = [f"{index['collection']}.{index['index']}: {index['status']}" for index in report if index["status"] != "exists"]
+    msg.append(f"索引共{len(report)}个，新建{sum(1 for index in report if index['status'] == 'created')}个。")
+    collscans = [name for name, stages in plans.items() if "COLLSCAN" in stages]
+    if collscans:
+        msg.append(f"以下查询仍为全表扫描：{', '.join(collscans)}")
+    else:
+        msg.append(f"{len(plans)}种查询均已命中索引。")
+    await index_check.finish("\n".join(msg))
+
+
 @rank.handle()
 async def _(bot: Bot, event: Event, args: Message = CommandArg()):
-    rank_result = await get_uploader_rank()
-    msg = []
+    period = str(args).strip()
+    match period:
+        case "周" | "本周" | "week":
+            rank_result = await get_uploader_rank("week")
+            msg = ["本周排行："]
+        case "月" | "本月" | "month":
+            rank_result = await get_uploader_rank("month")
+            msg = ["本月排行："]
+        case _:
+            rank_result = await get_uploader_rank()
+            msg = []
     for res in rank_result:
         msg.append(f"{await get_card_with_cache(res['_id'])}：{res['count']}")
     await rank.finish("\n".join(msg))
@@ -259,9 +312,9 @@ async def _(bot: Bot, event: Event):
     if get_ratelimited("daily_idiom"):
         return
     set_ratelimited("daily_idiom", 2)
-    random_idiom = await get_random_idiom()
-    img_filename = f"{random_idiom['image_hash']}.{random_idiom['image_ext']}"
-    img = await ei_img_storage_download(img_filename)
+    img = await draw_random_idiom()
+    if img is None:
+        return
     await bot.send(event, MessageSegment.image(img))
 
 
@@ -302,17 +355,19 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     #     await approve_idiom.finish(tips_no_permission)
     if len(args) == 0:
         await approve_idiom.finish("请输入要审核的ID。")
-    image_hashes = str(args).split()
+    image_hashes = [await hash_extender(image_hash, event.group_id) for image_hash in str(args).split()]
+    repo = IdiomRepository()
+    records = await repo.get_many(image_hashes)
 
     for image_hash in image_hashes:
-        image_hash = await hash_extender(image_hash, event.group_id)
-        image_ext = await get_ext_by_image_hash(image_hash)
-        image_bytes = await ei_img_storage_download(f"{image_hash}.{image_ext}")
+        image_bytes = await ei_img_storage_download(f"{image_hash}.{records[image_hash]['image_ext']}")
         ocr_text = await get_ocr_text_cloud(image_bytes)
         await update_review_status_by_image_hash(image_hash, False)
-        await es_update_review_status(image_hash, False)
+        await es_update_review_status(image_hash, False, refresh=False)
         await update_ocr_text_by_image_hash(image_hash, ocr_text)
-        await es_update_ocr_text(image_hash, ocr_text)
+        await es_update_ocr_text(image_hash, ocr_text, refresh=False)
+    # one refresh for the whole batch, check_dedup has to see the approved idioms
+    await refresh_es_index()
 
     upload_ok_quote = await check_dedup(image_hashes, "", event.group_id)
 
@@ -331,19 +386,20 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
         approve_count = int(str(args[0]))
     
     idiom_list = await get_under_review_idioms(approve_count)
+    # cut idiom_list length to approve_count
+    idiom_list = idiom_list[:approve_count]
     image_hashes = [idiom['image_hash'] for idiom in idiom_list]
-    # cut image_hashes length to approve_count
-    image_hashes = image_hashes[:approve_count]
 
-    for image_hash in image_hashes:
-        image_hash = await hash_extender(image_hash, event.group_id)
-        image_ext = await get_ext_by_image_hash(image_hash)
-        image_bytes = await ei_img_storage_download(f"{image_hash}.{image_ext}")
+    for idiom in idiom_list:
+        image_hash = idiom["image_hash"]
+        image_bytes = await ei_img_storage_download(f"{image_hash}.{idiom['image_ext']}")
         ocr_text = await get_ocr_text_cloud(image_bytes)
         await update_review_status_by_image_hash(image_hash, False)
-        await es_update_review_status(image_hash, False)
+        await es_update_review_status(image_hash, False, refresh=False)
         await update_ocr_text_by_image_hash(image_hash, ocr_text)
-        await es_update_ocr_text(image_hash, ocr_text)
+        await es_update_ocr_text(image_hash, ocr_text, refresh=False)
+    # one refresh for the whole batch, check_dedup has to see the approved idioms
+    await refresh_es_index()
 
     upload_ok_quote = await check_dedup(image_hashes, "", event.group_id)
 
@@ -355,26 +411,29 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     #     await reject_idiom.finish(tips_no_permission)
     if len(args) == 0:
         await reject_idiom.finish("请输入要审核的ID。")
-    image_hashes = str(args).split()
+    image_hashes = [await hash_extender(image_hash, event.group_id) for image_hash in str(args).split()]
+    repo = IdiomRepository()
+    records = await repo.get_many(image_hashes)
     for image_hash in image_hashes:
-        image_hash = await hash_extender(image_hash, event.group_id)
-        uploader = await get_uploader_by_hash(image_hash)
-        image_current_reviewing_status = await get_review_status_by_image_hash(image_hash)
+        uploader = records[image_hash]["uploader"]
+        image_current_reviewing_status = records[image_hash]["under_review"]
         if image_current_reviewing_status == True:
             if event.get_user_id() not in ei_upload_whitelist:
                 await reject_idiom.finish("您只有将已审核的图片标记为未审核的权限。")
             logger.info(
                 f"Rejected idiom {image_hash} is already rejected, so delete it instead.")
-            image_ext = await get_ext_by_image_hash(image_hash)
+            image_ext = records[image_hash]["image_ext"]
             await delete_idiom_by_image_hash(image_hash)
             await es_delete_idiom_by_image_hash(image_hash)
-            await ei_img_storage_delete(f"{image_hash}.{image_ext}")
+            await ei_img_storage_delete_many([f"{image_hash}.{image_ext}"] + thumbnail_keys(image_hash))
+            forget_thumbnails(image_hash)
             await greylist_incr(uploader["id"], uploader["platform"])
 
         else:
             logger.info(
                 f"Rejected idiom {image_hash} is not rejected, so reject it.")
             await update_review_status_by_image_hash(image_hash, True)
+            await es_update_review_status(image_hash, True)
 
     await reject_idiom.finish("已审核。")
 
@@ -426,7 +485,7 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
 3. 调取图片：调取 ID
 4. 审核列表：待审核列表(只取10条)
 """
-    ep_alias = await get_all_alias()
+    ep_alias = await get_alias_table()
     ei_non_admin_help_msg = "剩下的都是管理员命令，不告诉你。"
     ep_alias_text = ""
     for k, v in ep_alias.items():
@@ -463,10 +522,13 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     parsed_args = await ei_argparser(rest_args)
     if parsed_args["tag"] is not None:
         await edit_tags_by_hash(image_hash, parsed_args["tag"])
+        await es_edit_tags_by_hash(image_hash, parsed_args["tag"])
     if parsed_args["cat"] is not None:
         await edit_catalogue_by_image_hash(image_hash, parsed_args["cat"])
+        await es_edit_catalogue_by_hash(image_hash, parsed_args["cat"])
     if parsed_args["com"] is not None:
         await edit_comment_by_image_hash(image_hash, parsed_args["com"])
+        await es_edit_comment_by_hash(image_hash, parsed_args["com"])
     await edit.finish("编辑完成。")
 
 @add_cate.handle()
@@ -498,7 +560,7 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     cate_alias = [i for i in cate_alias if i != ""]
 
     cate_user_id = cate_user_id[0]
-    await mg_add_cate(cate_user_id, cate_alias)
+    await add_cate_alias(cate_user_id, cate_alias)
     await add_cate.finish("添加分类完成。")
 
 @append_cate.handle()
@@ -530,5 +592,5 @@ async def _(bot: Bot, event: Event, args: Message = CommandArg()):
     cate_alias = [i for i in cate_alias if i != ""]
 
     cate_user_id = cate_user_id[0]
-    await mg_append_cate(cate_user_id, cate_alias)
+    await append_cate_alias(cate_user_id, cate_alias)
     await append_cate.finish("添加分类完成。")
\ No newline at end of file
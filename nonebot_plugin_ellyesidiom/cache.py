@@ -0,0 +1,138 @@
+import asyncio
+import os
+import tempfile
+from collections import OrderedDict
+
+from nonebot.log import logger
+
+from .consts import global_config
+
+cache_dir: str = global_config.cache_dir
+ei_img_cache_max_bytes: int = getattr(global_config, "ei_img_cache_max_bytes", 2 * 1024 * 1024 * 1024)
+
+# filename -> size in bytes, ordered from least to most recently used
+cache_index: OrderedDict[str, int] = OrderedDict()
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def cache_path(filename: str) -> str:
+    # shard by hash prefix so no single directory grows without bound
+    return os.path.join(cache_dir, filename[:2], filename)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _write_file(path: str, data: bytes) -> None:
+    # write to a temp file and rename it over the target, readers never see a torn file
+    shard_dir = os.path.dirname(path)
+    os.makedirs(shard_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=shard_dir, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove_file(tmp_path)
+        raise
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _drop(filename: str) -> None:
+    size = cache_index.pop(filename, None)
+    if size is not None:
+        cache_stats["bytes"] -= size
+
+
+def _evict() -> None:
+    while cache_stats["bytes"] > ei_img_cache_max_bytes and cache_index:
+        filename, size = cache_index.popitem(last=False)
+        cache_stats["bytes"] -= size
+        _remove_file(cache_path(filename))
+        cache_stats["evictions"] += 1
+
+
+def rebuild_cache_index() -> None:
+    cache_index.clear()
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = list()
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.startswith(".tmp-"):
+            _remove_file(entry.path)
+        elif entry.is_file():
+            # flat layout from older versions, move it into its shard
+            target = cache_path(entry.name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(entry.path, target)
+            stat = os.stat(target)
+            entries.append((stat.st_atime, entry.name, stat.st_size))
+        elif entry.is_dir():
+            for shard_entry in os.scandir(entry.path):
+                if shard_entry.is_file() and shard_entry.name.startswith(".tmp-"):
+                    # left behind by a write interrupted mid-way
+                    _remove_file(shard_entry.path)
+                elif shard_entry.is_file():
+                    stat = shard_entry.stat()
+                    entries.append((stat.st_atime, shard_entry.name, stat.st_size))
+    entries.sort()
+    for _, filename, size in entries:
+        cache_index[filename] = size
+    cache_stats["bytes"] = sum(cache_index.values())
+    _evict()
+    logger.info(f"Image cache index rebuilt: {len(cache_index)} files, {cache_stats['bytes']} bytes")
+
+
+def cache_contains(filename: str) -> bool:
+    return filename in cache_index
+
+
+async def cache_get(filename: str) -> bytes | None:
+    if filename not in cache_index:
+        cache_stats["misses"] += 1
+        return None
+    try:
+        data = await asyncio.to_thread(_read_file, cache_path(filename))
+    except FileNotFoundError:
+        _drop(filename)
+        cache_stats["misses"] += 1
+        return None
+    if filename in cache_index:
+        cache_index.move_to_end(filename)
+    cache_stats["hits"] += 1
+    return data
+
+
+async def cache_put(filename: str, data: bytes) -> None:
+    await asyncio.to_thread(_write_file, cache_path(filename), data)
+    _drop(filename)
+    cache_index[filename] = len(data)
+    cache_stats["bytes"] += len(data)
+    _evict()
+
+
+async def cache_remove(filename: str) -> None:
+    if filename not in cache_index:
+        return
+    _drop(filename)
+    await asyncio.to_thread(_remove_file, cache_path(filename))
+
+
+def get_cache_stats() -> dict:
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        **cache_stats,
+        "files": len(cache_index),
+        "max_bytes": ei_img_cache_max_bytes,
+        "hit_ratio": cache_stats["hits"] / lookups if lookups else 0.0,
+    }
+
+
+rebuild_cache_index()
@@ -1,18 +1,87 @@
+import asyncio
+import time
+
 import fuzzywuzzy.process as fuzz
-from .data_mongo import get_all_alias
+from .consts import global_config
+from .data_mongo import get_all_alias, add_cate as mg_add_cate, append_cate as mg_append_cate
+from .data_redis import bump_cate_version, subscribe_cate_changes
+from .query_cache import invalidate_query_cache
+
+# reload anyway after this long, in case a pubsub message was lost while redis was unreachable
+ei_alias_table_ttl: int = getattr(global_config, "ei_alias_table_ttl", 600)
+
+# category id -> aliases, first alias is the display name
+alias_by_id: dict[str, list[str]] = dict()
+id_by_alias: dict[str, str] = dict()
+alias_table_loaded_at = 0.0
+alias_table_stale = True
+alias_table_lock = asyncio.Lock()
+
+
+def _mark_stale(message=None) -> None:
+    global alias_table_stale
+    alias_table_stale = True
+
+
+subscribe_cate_changes(_mark_stale)
+
+
+def _needs_reload() -> bool:
+    return alias_table_stale or time.monotonic() - alias_table_loaded_at > ei_alias_table_ttl
+
+
+async def get_alias_table() -> dict[str, list[str]]:
+    global alias_table_loaded_at, alias_table_stale
+    if _needs_reload():
+        async with alias_table_lock:
+            if _needs_reload():
+                alias_table_stale = False
+                ep_alias: dict[str, list[str]] = await get_all_alias()
+                reverse = dict()
+                for ep, alias in ep_alias.items():
+                    for name in alias:
+                        reverse.setdefault(name, ep)
+                alias_by_id.clear()
+                alias_by_id.update(ep_alias)
+                id_by_alias.clear()
+                id_by_alias.update(reverse)
+                alias_table_loaded_at = time.monotonic()
+    return alias_by_id
+
+
+def invalidate_alias_table() -> None:
+    _mark_stale()
+    # cached search results carry display names
+    invalidate_query_cache()
+    # other bot instances reload through the CATE_CHANGED subscription
+    bump_cate_version()
+
+
+async def add_cate(id: str, alias: list[str]) -> None:
+    await mg_add_cate(id, alias)
+    invalidate_alias_table()
+
+
+async def append_cate(id: str, alias: list[str]) -> None:
+    await mg_append_cate(id, alias)
+    invalidate_alias_table()
+
 
 async def ep_alias_to_id(name: str) -> str | None:
-    ep_alias: dict[str, list[str]] = await get_all_alias()
+    ep_alias = await get_alias_table()
+    if name in id_by_alias:
+        return id_by_alias[name]
     for ep, alias in ep_alias.items():
-        if name in alias:
-            return ep
         if fuzz.extractOne(name, alias)[1] > 80:
             return ep
     return None
 
 async def id_to_ep_alias(id: str) -> str | None:
-    ep_alias: dict[str, list[str]] = await get_all_alias()
-    for ep, alias in ep_alias.items():
-        if id == ep:
-            return alias[0]
-    return None
\ No newline at end of file
+    alias = (await get_alias_table()).get(id)
+    return alias[0] if alias else None
+
+
+async def ids_to_ep_aliases(ids: list[str]) -> list[str]:
+    # display names for a whole catalogue list from one table lookup, unknown ids are shown as is
+    ep_alias = await get_alias_table()
+    return [ep_alias[id][0] if ep_alias.get(id) else id for id in ids]
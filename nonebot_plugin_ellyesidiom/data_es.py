@@ -1,8 +1,12 @@
-from elasticsearch import Elasticsearch
-from numpy import indices
-from sympy import true
+import asyncio
+
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import BulkIndexError, async_bulk, async_streaming_bulk
+from nonebot import get_driver
+from nonebot.log import logger
 
 from .consts import global_config
+from .query_cache import expire_query_cache
 
 es_scheme = "http"
 es_host: str = global_config.es_host
@@ -10,80 +14,278 @@ es_port: int = global_config.es_port
 es_index: str = global_config.es_index
 es_user = global_config.es_user
 es_pass = global_config.es_pass
+es_pool_size: int = getattr(global_config, "es_pool_size", 10)
+es_max_retries: int = getattr(global_config, "es_max_retries", 3)
+es_search_timeout: float = getattr(global_config, "es_search_timeout", 5)
+es_write_timeout: float = getattr(global_config, "es_write_timeout", 30)
+# immediate: refresh after every write, wait_for: return once the write is searchable,
+# periodic: leave it to the index refresh_interval and queue writes without waiting on them
+es_refresh_policy: str = getattr(global_config, "es_refresh_policy", "wait_for")
+es_batch_size: int = getattr(global_config, "es_batch_size", 500)
+es_batch_window: float = getattr(global_config, "es_batch_window", 0.2)
+
+if es_refresh_policy not in ("immediate", "wait_for", "periodic"):
+    raise ValueError(f"invalid es_refresh_policy: {es_refresh_policy}")
+
+
+es = AsyncElasticsearch(f"{es_scheme}://{es_host}:{es_port}",
+                        basic_auth=(es_user, es_pass),
+                        connections_per_node=es_pool_size,
+                        max_retries=es_max_retries,
+                        retry_on_timeout=True)
+# reads should fail fast, writes and by-query updates may legitimately take longer
+es_read = es.options(request_timeout=es_search_timeout)
+es_write = es.options(request_timeout=es_write_timeout)
+
+
+def resolve_refresh(refresh: bool | str | None = None) -> bool | str:
+    if refresh is None:
+        return {"immediate": True, "wait_for": "wait_for", "periodic": False}[es_refresh_policy]
+    return refresh
+
+
+def _strongest_refresh(refreshes: list[bool | str]) -> bool | str:
+    if True in refreshes:
+        return True
+    if "wait_for" in refreshes:
+        return "wait_for"
+    return False
+
+
+class EsWriteBatcher:
+    """Coalesces single document writes into bulk requests.
+
+    A batch is sent once it holds ``max_actions`` actions or ``window`` seconds after its first
+    action, with the strongest refresh any of its writers asked for.
+    """
+
+    def __init__(self, max_actions: int, window: float) -> None:
+        self.max_actions = max_actions
+        self.window = window
+        self.actions: list[dict] = list()
+        # None for queued writes nobody waits on, their failures are only logged,
+        # a waiter gets the failure of its own action
+        self.waiters: list[asyncio.Future | None] = list()
+        self.refreshes: list[bool | str] = list()
+        self.timer: asyncio.TimerHandle | None = None
+        self.flushing: set[asyncio.Task] = set()
+        # one bulk request at a time, so an update never overtakes the index it depends on
+        self.lock = asyncio.Lock()
+
+    async def submit(self, action: dict, refresh: bool | str | None = None, wait: bool = True) -> None:
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future() if wait else None
+        self.actions.append(action)
+        self.waiters.append(waiter)
+        self.refreshes.append(resolve_refresh(refresh))
+        if len(self.actions) >= self.max_actions:
+            self._flush_soon()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self._flush_soon)
+        if waiter is not None:
+            await waiter
+
+    def _flush_soon(self) -> None:
+        task = asyncio.ensure_future(self.flush())
+        self.flushing.add(task)
+        task.add_done_callback(self.flushing.discard)
+
+    async def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        async with self.lock:
+            await self._send()
+
+    async def _send(self) -> None:
+        if not self.actions:
+            return
+        actions, waiters, refreshes = self.actions, self.waiters, self.refreshes
+        self.actions, self.waiters, self.refreshes = list(), list(), list()
+        try:
+            # results come back in action order, so each one resolves the waiter of its own action
+            results = async_streaming_bulk(es_write, actions, chunk_size=len(actions),
+                                           refresh=_strongest_refresh(refreshes), raise_on_error=False)
+            position = 0
+            async for ok, item in results:
+                waiter = waiters[position]
+                position += 1
+                # deleting an idiom that is already gone is not worth a warning
+                if not ok and item.get("delete", {}).get("status") != 404:
+                    logger.warning(f"ES bulk write error: {item}")
+                    if waiter is not None and not waiter.done():
+                        waiter.set_exception(BulkIndexError("1 document(s) failed to index.", [item]))
+                    continue
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(None)
+        except Exception as e:
+            logger.error(f"ES bulk write of {len(actions)} actions failed: {e}")
+            for waiter in waiters:
+                if waiter is not None and not waiter.done():
+                    waiter.set_exception(e)
+            return
+        # searches that ran between the mongo write and this one may have cached the old hits here,
+        # other instances were already told by the mongo write, so this stays local
+        expire_query_cache()
 
+    async def drain(self) -> None:
+        await self.flush()
+        if self.flushing:
+            await asyncio.gather(*self.flushing, return_exceptions=True)
 
-es = Elasticsearch(f"{es_scheme}://{es_host}:{es_port}",
-                   http_auth=(es_user, es_pass))
 
+es_batcher = EsWriteBatcher(es_batch_size, es_batch_window)
 
-async def search_idiom(query_str: str) -> dict:
-    return es.search(index=es_index, query={
+
+async def flush_es_writes() -> None:
+    await es_batcher.drain()
+
+
+async def refresh_es_index() -> None:
+    # for callers that wrote with refresh=False in a loop and need the results searchable once at the end
+    await flush_es_writes()
+    await es_write.indices.refresh(index=es_index)
+
+
+# exact match filter fields, mapped up front so dynamic mapping does not analyse them as text
+filter_field_mappings = {
+    "under_review": {"type": "boolean"},
+    "catalogue": {"type": "keyword"},
+    "comment": {"type": "keyword"},
+}
+
+
+async def ensure_es_mapping() -> None:
+    try:
+        await es_write.indices.put_mapping(index=es_index, properties=filter_field_mappings)
+    except Exception as e:
+        logger.warning(f"Failed to map ES filter fields, filtered searches may miss results: {e}")
+
+
+@get_driver().on_startup
+async def _():
+    await ensure_es_mapping()
+
+
+@get_driver().on_shutdown
+async def _():
+    await flush_es_writes()
+    await es.close()
+
+
+async def search_idiom(query_str: str, catalogue: list[str] | None = None, comment: list[str] | None = None,
+                       approved_only: bool = False, size: int = 10, min_score: float | None = None) -> dict:
+    # filter clauses do not score and are cached by ES, so restricting a search costs no extra round trip
+    filters = list()
+    if approved_only:
+        filters.append({"term": {"under_review": False}})
+    if catalogue:
+        filters.append({"terms": {"catalogue": catalogue}})
+    if comment:
+        filters.append({"terms": {"comment": comment}})
+    return await es_read.search(index=es_index, query={
         "bool": {
             "must": {
                 "multi_match": {
                     "query": query_str,
                     "fields": ["tags^10", "ocr_text"]
                 }
-            }
+            },
+            "filter": filters
         }
-    }
+    }, size=size, min_score=min_score
     )
 
 
-async def add_idiom(tags: list[str], image_hash: str, ocr_text: list[str], under_review: bool) -> dict:
+async def _submit(action: dict, refresh: bool | str | None) -> None:
+    # refresh=False, or the periodic policy without an explicit refresh, only queues the write
+    if refresh is None:
+        wait = es_refresh_policy != "periodic"
+    else:
+        wait = refresh is not False
+    await es_batcher.submit(action, refresh, wait)
+
+
+async def add_idiom(tags: list[str], image_hash: str, ocr_text: list[str], under_review: bool,
+                    comment: list[str], catalogue: list[str], refresh: bool | str | None = None) -> None:
     body = {
         "image_hash": image_hash,
         "tags": tags,
         "ocr_text": ocr_text,
-        "under_review": under_review
+        "under_review": under_review,
+        "comment": comment,
+        "catalogue": catalogue
     }
-    return es.index(index=es_index, document=body, refresh=True)
+    # keyed by image_hash, indexing the same image again overwrites instead of duplicating
+    await _submit({"_op_type": "index", "_index": es_index, "_id": image_hash, "_source": body}, refresh)
 
 
-async def delete_idiom_by_image_hash(hash: str) -> dict:
-    return es.delete_by_query(index=es_index, query={
-        "term": {
-            "image_hash": hash
-        }
-    }, refresh=True)
+async def delete_idiom_by_image_hash(hash: str, refresh: bool | str | None = None) -> None:
+    await _submit({"_op_type": "delete", "_index": es_index, "_id": hash}, refresh)
 
 
-async def update_ocr_text(image_hash: str, ocr_text: list[str]) -> dict:
-    return es.update_by_query(index=es_index, query={
-        "match": {
-            "image_hash": image_hash
-        }
-    },
+async def delete_idioms_by_image_hashes(hashes: list[str], refresh: bool | str | None = None) -> None:
+    await asyncio.gather(*[delete_idiom_by_image_hash(hash, refresh) for hash in hashes])
 
-        script={
-            "source": "ctx._source.ocr_text = params.ocr_text",
-            "lang": "painless",
-            "params": {
-                "ocr_text": ocr_text
-            }
-    },
-        refresh=True
-    )
+
+async def _update_fields(image_hash: str, fields: dict, refresh: bool | str | None) -> None:
+    await _submit({
+        "_op_type": "update",
+        "_index": es_index,
+        "_id": image_hash,
+        "doc": fields
+    }, refresh)
+
+
+async def update_ocr_text(image_hash: str, ocr_text: list[str], refresh: bool | str | None = None) -> None:
+    await _update_fields(image_hash, {"ocr_text": ocr_text}, refresh)
+
+
+async def edit_tags_by_hash(image_hash: str, tags: list[str], refresh: bool | str | None = None) -> None:
+    await _update_fields(image_hash, {"tags": tags}, refresh)
+
+
+async def edit_catalogue_by_hash(image_hash: str, catalogue: list[str], refresh: bool | str | None = None) -> None:
+    await _update_fields(image_hash, {"catalogue": catalogue}, refresh)
+
+
+async def edit_comment_by_hash(image_hash: str, comment: list[str], refresh: bool | str | None = None) -> None:
+    await _update_fields(image_hash, {"comment": comment}, refresh)
 
 
-async def add_tags_by_hash(id: str, tags: list[str]) -> dict:
-    return es.update_by_query(index=es_index, query={
-        "term": {
-            "image_hash": id
-        }},
-        script={
+async def bulk_update_ocr_text(ocr_texts: dict[str, list[str]]) -> int:
+    if not ocr_texts:
+        return 0
+    actions = [{
+        "_op_type": "update",
+        "_index": es_index,
+        "_id": image_hash,
+        "doc": {"ocr_text": ocr_text}
+    } for image_hash, ocr_text in ocr_texts.items()]
+    success, errors = await async_bulk(es_write, actions, refresh=resolve_refresh(), raise_on_error=False)
+    expire_query_cache()
+    for error in errors:
+        logger.warning(f"ES bulk write error: {error}")
+    return success
+
+
+async def add_tags_by_hash(id: str, tags: list[str], refresh: bool | str | None = None) -> None:
+    await _submit({
+        "_op_type": "update",
+        "_index": es_index,
+        "_id": id,
+        "script": {
             "source": "ctx._source.tags.addAll(params.tags)",
             "lang": "painless",
             "params": {
                 "tags": tags
             }
-    },
-        refresh=True
-    )
+        }
+    }, refresh)
 
 
-async def find_similar_idioms_by_ocr_text(ocr_text: str) -> dict:
-    return es.search(index=es_index, query={
+def _similar_ocr_text_query(ocr_text: str) -> dict:
+    return {
         "bool": {
             "must": [
                 {
@@ -100,19 +302,24 @@ async def find_similar_idioms_by_ocr_text(ocr_text: str) -> dict:
             ]
         }
     }
-    )
 
 
-async def update_under_review_by_hash(id: str, under_review: bool) -> dict:
-    return es.update_by_query(index=es_index, query={
-        "term": {
-            "image_hash": id
-        }
-    },
-        script={
-            "source": "ctx._source.under_review = params.under_review",
-            "lang": "painless",
-            "params": {
-                "under_review": under_review
-            }
-    }, refresh=True)
+async def find_similar_idioms_by_ocr_text(ocr_text: str) -> dict:
+    return await es_read.search(index=es_index, query=_similar_ocr_text_query(ocr_text))
+
+
+async def find_similar_idioms_by_ocr_texts(ocr_texts: list[str], size: int = 2) -> list[dict]:
+    # one _msearch round trip for a whole batch, a failed sub-search comes back as an empty result
+    if not ocr_texts:
+        return []
+    searches = list()
+    for ocr_text in ocr_texts:
+        searches.append({"index": es_index})
+        searches.append({"query": _similar_ocr_text_query(ocr_text), "size": size})
+    responses = (await es_read.msearch(searches=searches))["responses"]
+    empty = {"hits": {"hits": []}}
+    return [empty if "error" in response else response for response in responses]
+
+
+async def update_under_review_by_hash(id: str, under_review: bool, refresh: bool | str | None = None) -> None:
+    await _update_fields(id, {"under_review": under_review}, refresh)
@@ -1,9 +1,24 @@
+import asyncio
 import datetime
-from pymongo import MongoClient
+import re
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from nonebot import get_driver
+from nonebot.log import logger
+from pymongo import IndexModel, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
 
 from .consts import shanghai_tz, global_config
 
+from bson import ObjectId
 from bson.codec_options import CodecOptions
+from xxhash import xxh3_64_hexdigest
+
+from . import hash_index
+from . import ocr_lsh
+from . import phash
+from .query_cache import invalidate_query_cache
+from .data_redis import remove_from_random_deck, publish_hash_change, subscribe_hash_changes
 
 codec_opt = CodecOptions(tz_aware=True, tzinfo=shanghai_tz)
 
@@ -11,8 +26,16 @@ codec_opt = CodecOptions(tz_aware=True, tzinfo=shanghai_tz)
 mongo_host = global_config.mongo_host
 mongo_user = global_config.mongo_user
 mongo_pass = global_config.mongo_pass
+mongo_pool_size: int = getattr(global_config, "mongo_pool_size", 20)
+# upper bound for a single operation, including server selection and retries
+mongo_timeout_ms: int = getattr(global_config, "mongo_timeout_ms", 10000)
 
-client = MongoClient(f'mongodb://{mongo_user}:{mongo_pass}@{mongo_host}:27017/')
+client = AsyncIOMotorClient(f'mongodb://{mongo_user}:{mongo_pass}@{mongo_host}:27017/',
+                            maxPoolSize=mongo_pool_size,
+                            minPoolSize=min(2, mongo_pool_size),
+                            connectTimeoutMS=min(5000, mongo_timeout_ms),
+                            serverSelectionTimeoutMS=min(5000, mongo_timeout_ms),
+                            timeoutMS=mongo_timeout_ms)
 
 ei_data = client.ei_data
 me_data = client.me_data
@@ -21,11 +44,186 @@ idioms_data = ei_data.idioms.with_options(codec_options=codec_opt)
 greylist_data = ei_data.greylist.with_options(codec_options=codec_opt)
 cards_data = me_data.cards.with_options(codec_options=codec_opt)
 cate_data = ei_data.cate.with_options(codec_options=codec_opt)
+# materialized counters kept in step with idioms, see _apply_idiom_counters
+stats_data = ei_data.stats
+uploader_stats_data = ei_data.uploader_stats
+
+ei_stats_reconcile_interval: int = getattr(global_config, "ei_stats_reconcile_interval", 24 * 3600)
+
+required_indexes = [
+    (idioms_data, [
+        IndexModel([("image_hash", ASCENDING)], name="image_hash_unique", unique=True),
+        IndexModel([("under_review", ASCENDING), ("timestamp", DESCENDING)], name="under_review_timestamp"),
+        IndexModel([("catalogue", ASCENDING)], name="catalogue"),
+        IndexModel([("comment", ASCENDING)], name="comment"),
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+        IndexModel([("ocr_fingerprint", ASCENDING)], name="ocr_fingerprint"),
+    ]),
+    (cards_data, [IndexModel([("id", ASCENDING)], name="id")]),
+    (cate_data, [IndexModel([("id", ASCENDING)], name="id")]),
+    (greylist_data, [IndexModel([("user_id", ASCENDING), ("platform", ASCENDING)], name="user_id_platform")]),
+    (uploader_stats_data, [
+        IndexModel([("bucket", ASCENDING), ("platform", ASCENDING), ("uploader_id", ASCENDING)], name="bucket_uploader_unique", unique=True),
+        IndexModel([("bucket", ASCENDING), ("platform", ASCENDING), ("count", DESCENDING)], name="bucket_rank"),
+    ]),
+]
+
+# (name, collection, filter, sort) of every query data_mongo issues that must be served by an index
+query_patterns = [
+    ("image_hash", idioms_data, {"image_hash": "0"}, None),
+    ("image_hash prefix", idioms_data, {"image_hash": {"$regex": "^0"}}, None),
+    ("image_hash $in", idioms_data, {"image_hash": {"$in": ["0", "1"]}}, None),
+    ("under_review", idioms_data, {"under_review": True}, None),
+    ("catalogue", idioms_data, {"catalogue": "0"}, None),
+    ("comment", idioms_data, {"comment": "0"}, None),
+    ("catalogue and comment", idioms_data, {"under_review": False, "catalogue": {"$in": ["0"]}, "comment": {"$in": ["0"]}}, None),
+    ("ocr_fingerprint", idioms_data, {"ocr_fingerprint": "0"}, None),
+    ("latest", idioms_data, {}, [("timestamp", DESCENDING)]),
+    ("cards id", cards_data, {"id": "0"}, None),
+    ("cate id", cate_data, {"id": "0"}, None),
+    ("greylist user", greylist_data, {"user_id": "0", "platform": "qq"}, None),
+    ("uploader rank", uploader_stats_data, {"bucket": "all", "platform": "qq", "count": {"$gt": 0}}, [("count", DESCENDING)]),
+]
+
+
+async def ensure_indexes() -> list[dict]:
+    report = list()
+    for collection, indexes in required_indexes:
+        existing = set()
+        async for index in collection.list_indexes():
+            existing.add(index["name"])
+        for index in indexes:
+            name = index.document["name"]
+            status = {"collection": collection.full_name, "index": name}
+            if name in existing:
+                status["status"] = "exists"
+            else:
+                try:
+                    # building on a large collection can take longer than the per-operation timeout
+                    with pymongo.timeout(None):
+                        await collection.create_indexes([index])
+                    status["status"] = "created"
+                except PyMongoError as e:
+                    status["status"] = f"failed: {e}"
+            report.append(status)
+            if status["status"].startswith("failed"):
+                logger.error(f"Index {status['collection']}.{name} {status['status']}")
+            else:
+                logger.info(f"Index {status['collection']}.{name} {status['status']}")
+    return report
+
+
+def _plan_stages(plan) -> list[str]:
+    stages = list()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+async def check_query_plans() -> dict[str, list[str]]:
+    # maps every query pattern to the stages of its winning plan, patterns that collection scan are logged
+    plans = dict()
+    for name, collection, query, sort in query_patterns:
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort).limit(25)
+        explain = await cursor.explain()
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        plans[name] = stages
+        if "COLLSCAN" in stages:
+            logger.error(f"Query pattern {name} on {collection.full_name} falls back to COLLSCAN")
+    return plans
+
+
+# the loop prefix index changes from other instances are applied on, set once the bot has started
+main_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _apply_hash_change(op: str, image_hashes: list[str]) -> None:
+    for image_hash in image_hashes:
+        if op == "add":
+            hash_index.add_hash(image_hash)
+        elif op == "remove":
+            hash_index.remove_hash(image_hash)
+
+
+def _on_hash_changed(message) -> None:
+    # runs in the pubsub thread, the index itself is only touched on the event loop.
+    # our own messages are applied again, which is harmless since add and remove are idempotent
+    if main_loop is None:
+        return
+    data = message["data"]
+    op, _, hashes = (data.decode("utf-8") if isinstance(data, bytes) else str(data)).partition(":")
+    if hashes:
+        main_loop.call_soon_threadsafe(_apply_hash_change, op, hashes.split(","))
+
+
+subscribe_hash_changes(_on_hash_changed)
+
+
+def _log_hash_broadcast_failure(future) -> None:
+    if future.exception() is not None:
+        logger.warning(f"Failed to broadcast prefix index change: {future.exception()}")
+
+
+def broadcast_hash_change(op: str, image_hashes: list[str]) -> None:
+    # best effort and off the event loop, other instances still fall back to mongo when their index misses
+    if not image_hashes or main_loop is None:
+        return
+    main_loop.run_in_executor(None, publish_hash_change, op, image_hashes).add_done_callback(_log_hash_broadcast_failure)
+
+
+@get_driver().on_startup
+async def _():
+    global main_loop
+    main_loop = asyncio.get_running_loop()
+    await ensure_indexes()
+    await load_hash_index()
+    await load_phash_index()
+    global reconcile_task, backfill_task, ocr_lsh_task
+    reconcile_task = asyncio.create_task(reconcile_counters_loop())
+    backfill_task = asyncio.create_task(backfill_ocr_fingerprints())
+    if ocr_lsh.ei_dedup_lsh:
+        ocr_lsh_task = asyncio.create_task(load_ocr_lsh_index())
+
+def ocr_fingerprint(ocr_text: list[str] | None) -> str | None:
+    # hash of the text with whitespace, punctuation and control characters dropped and case folded
+    text = ocr_lsh.normalize_ocr_text(ocr_text)
+    if not text:
+        return None
+    return xxh3_64_hexdigest(text.encode("utf-8"))
+
+
+backfill_task: asyncio.Task | None = None
+
+
+async def backfill_ocr_fingerprints(batch_size: int = 500) -> int:
+    count = 0
+    operations = list()
+    async for idiom in idioms_data.find({"ocr_fingerprint": {"$exists": False}}, {"_id": 1, "ocr_text": 1}):
+        operations.append(UpdateOne({"_id": idiom["_id"]}, {"$set": {"ocr_fingerprint": ocr_fingerprint(idiom.get("ocr_text"))}}))
+        if len(operations) >= batch_size:
+            await idioms_data.bulk_write(operations, ordered=False)
+            count += len(operations)
+            operations = list()
+    if operations:
+        await idioms_data.bulk_write(operations, ordered=False)
+        count += len(operations)
+    if count:
+        logger.info(f"Backfilled ocr_fingerprint for {count} idioms")
+    return count
+
 
 async def get_idiom_by_image_hash(image_hash: str) -> dict:
-    return idioms_data.find_one({"image_hash": image_hash})
+    return await idioms_data.find_one({"image_hash": image_hash})
 
-async def add_idiom(tags: list[str], image_hash: str, image_ext:str, ocr_text: list[str], uploader_info: dict, under_review: bool, comment: list[str], catalogue: list[str]) -> dict:
+async def add_idiom(tags: list[str], image_hash: str, image_ext:str, ocr_text: list[str], uploader_info: dict, under_review: bool, comment: list[str], catalogue: list[str], image_phash: str | None = None) -> dict:
     body = {
         "tags": tags,
         "image_hash": image_hash,
@@ -35,106 +233,382 @@ async def add_idiom(tags: list[str], image_hash: str, image_ext:str, ocr_text: l
         "under_review": under_review,
         "comment": comment,
         "catalogue": catalogue,
+        "ocr_fingerprint": ocr_fingerprint(ocr_text),
+        "phash": image_phash,
         "timestamp": datetime.datetime.now(shanghai_tz)
     }
-    return idioms_data.insert_one(body)
+    result = await idioms_data.insert_one(body)
+    hash_index.add_hash(image_hash)
+    broadcast_hash_change("add", [image_hash])
+    phash.add_phash(image_hash, image_phash)
+    invalidate_query_cache()
+    if ocr_lsh.ei_dedup_lsh and not under_review:
+        ocr_lsh.add_signature(image_hash, await asyncio.to_thread(ocr_lsh.minhash, ocr_text))
+    await _apply_idiom_counters(body, 1)
+    return result
 
 async def delete_idiom_by_image_hash(image_hash: str) -> None:
-    idioms_data.delete_one({"image_hash": image_hash})
+    deleted = await idioms_data.find_one_and_delete({"image_hash": image_hash}, projection=counter_projection)
+    hash_index.remove_hash(image_hash)
+    ocr_lsh.remove_ocr_text(image_hash)
+    phash.remove_phash(image_hash)
+    if deleted:
+        broadcast_hash_change("remove", [image_hash])
+        invalidate_query_cache()
+        await _apply_idiom_counters(deleted, -1)
+
+async def delete_idioms_by_image_hashes(image_hashes: list[str]) -> int:
+    deleted = await idioms_data.find({"image_hash": {"$in": image_hashes}}, counter_projection).to_list(length=None)
+    result = await idioms_data.delete_many({"image_hash": {"$in": image_hashes}})
+    for image_hash in image_hashes:
+        hash_index.remove_hash(image_hash)
+        ocr_lsh.remove_ocr_text(image_hash)
+        phash.remove_phash(image_hash)
+    if deleted:
+        broadcast_hash_change("remove", image_hashes)
+        invalidate_query_cache()
+    for idiom in deleted:
+        await _apply_idiom_counters(idiom, -1)
+    return result.deleted_count
 
 async def update_ocr_text_by_image_hash(image_hash: str, ocr_text: list[str]) -> None:
-    idioms_data.update_one({"image_hash": image_hash}, {"$set": {"ocr_text": ocr_text}})
+    idiom = await idioms_data.find_one_and_update(
+        {"image_hash": image_hash},
+        {"$set": {"ocr_text": ocr_text, "ocr_fingerprint": ocr_fingerprint(ocr_text)}},
+        projection={"_id": 0, "under_review": 1}
+    )
+    # every approved idiom, not only indexed ones: one approved with empty OCR text is indexed here first
+    if ocr_lsh.ei_dedup_lsh and idiom and not idiom.get("under_review"):
+        ocr_lsh.add_signature(image_hash, await asyncio.to_thread(ocr_lsh.minhash, ocr_text))
+    invalidate_query_cache()
+
+async def _get_review_counters() -> dict:
+    counters = await stats_data.find_one({"_id": "review"})
+    if counters is None:
+        await reconcile_counters()
+        counters = await stats_data.find_one({"_id": "review"})
+    return counters
+
+async def get_ocr_text_batch(after_id: str | None, batch_size: int) -> list[dict]:
+    # walks the collection in _id order, after_id is the checkpoint of the previous batch
+    query = {"_id": {"$gt": ObjectId(after_id)}} if after_id else {}
+    cursor = idioms_data.find(query, {"_id": 1, "image_hash": 1, "ocr_text": 1}).sort("_id", ASCENDING).limit(batch_size)
+    return await cursor.to_list(length=None)
+
+async def bulk_update_ocr_text(ocr_texts: dict[str, list[str]]) -> int:
+    if not ocr_texts:
+        return 0
+    result = await idioms_data.bulk_write([
+        UpdateOne({"image_hash": image_hash}, {"$set": {"ocr_text": ocr_text, "ocr_fingerprint": ocr_fingerprint(ocr_text)}})
+        for image_hash, ocr_text in ocr_texts.items()
+    ], ordered=False)
+    if ocr_lsh.ei_dedup_lsh:
+        approved = [idiom["image_hash"] async for idiom in idioms_data.find(
+            {"image_hash": {"$in": list(ocr_texts)}, "under_review": False}, {"_id": 0, "image_hash": 1})]
+        new_signatures = await asyncio.to_thread(ocr_lsh.minhash_many, [ocr_texts[image_hash] for image_hash in approved])
+        for image_hash, signature in zip(approved, new_signatures):
+            ocr_lsh.add_signature(image_hash, signature)
+    if result.modified_count:
+        invalidate_query_cache()
+    return result.modified_count
+
+async def count_idioms() -> int:
+    return await idioms_data.estimated_document_count()
 
 async def count_under_review() -> int:
-    return idioms_data.count_documents({"under_review": True})
+    return (await _get_review_counters()).get("under_review", 0)
 
 async def count_reviewed() -> int:
-    return idioms_data.count_documents({"under_review": False})
+    return (await _get_review_counters()).get("reviewed", 0)
 
 async def add_tags_by_hash(image_hash: str, tags: list[str]) -> None:
-    idioms_data.update_one({"image_hash": image_hash}, {"$addToSet": {"tags": {"$each": tags}}})
+    await idioms_data.update_one({"image_hash": image_hash}, {"$addToSet": {"tags": {"$each": tags}}})
+    invalidate_query_cache()
 
 async def edit_tags_by_hash(image_hash: str, tags: list[str]) -> None:
-    idioms_data.update_one({"image_hash": image_hash}, {"$set": {"tags": tags}})
+    await idioms_data.update_one({"image_hash": image_hash}, {"$set": {"tags": tags}})
+    invalidate_query_cache()
 
 async def edit_comment_by_image_hash(image_hash: str, comment: list[str]) -> None:
-    idioms_data.update_one({"image_hash": image_hash}, {"$set": {"comment": comment}})
+    await idioms_data.update_one({"image_hash": image_hash}, {"$set": {"comment": comment}})
+    invalidate_query_cache()
 
 async def edit_catalogue_by_image_hash(image_hash: str, catalogue: list[str]) -> None:
-    idioms_data.update_one({"image_hash": image_hash}, {"$set": {"catalogue": catalogue}})
+    await idioms_data.update_one({"image_hash": image_hash}, {"$set": {"catalogue": catalogue}})
+    invalidate_query_cache()
 
 async def get_id_by_image_hash(image_hash: str) -> str:
-    return idioms_data.find_one({"image_hash": image_hash})["_id"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["_id"]
 
 async def get_ext_by_image_hash(image_hash: str) -> str:
-    return idioms_data.find_one({"image_hash": image_hash})["image_ext"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["image_ext"]
 
 async def check_image_hash_exists(image_hash: str) -> bool:
-    return idioms_data.count_documents({"image_hash": image_hash}) > 0
+    return await idioms_data.count_documents({"image_hash": image_hash}) > 0
 
 async def update_review_status_by_image_hash(image_hash: str, under_review: bool) -> None:
-    idioms_data.update_one({"image_hash": image_hash}, {"$set": {"under_review": under_review}})
+    # only matches when the status really changes, so counters move once per transition
+    before = await idioms_data.find_one_and_update(
+        {"image_hash": image_hash, "under_review": {"$ne": under_review}},
+        {"$set": {"under_review": under_review}},
+        projection={**counter_projection, "ocr_text": 1, "image_ext": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before:
+        invalidate_query_cache()
+        await _apply_idiom_counters(before, -1)
+        await _apply_idiom_counters({**before, "under_review": under_review}, 1)
+        if under_review:
+            ocr_lsh.remove_ocr_text(image_hash)
+            # the image is still in storage, 每日怡言 must not draw it until it is approved again
+            try:
+                remove_from_random_deck(f"{image_hash}.{before['image_ext']}")
+            except Exception as e:
+                logger.warning(f"Failed to remove {image_hash} from the random deck: {e}")
+        elif ocr_lsh.ei_dedup_lsh:
+            ocr_lsh.add_signature(image_hash, await asyncio.to_thread(ocr_lsh.minhash, before.get("ocr_text")))
 
 async def get_review_status_by_image_hash(image_hash: str) -> bool:
-    return idioms_data.find_one({"image_hash": image_hash})["under_review"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["under_review"]
 
-async def get_under_review_idioms(limit: 10) -> list[dict]:
-    return idioms_data.find({"under_review": True}).limit(limit)
+async def get_under_review_idioms(limit: int = 10) -> list[dict]:
+    return await idioms_data.find({"under_review": True}).limit(limit).to_list(length=None)
 
 async def check_ocr_text_exists(ocr_text: list[str]) -> bool:
-    return idioms_data.count_documents({"ocr_text": ocr_text}) > 0
+    fingerprint = ocr_fingerprint(ocr_text)
+    if fingerprint is None:
+        return False
+    return await idioms_data.find_one({"ocr_fingerprint": fingerprint}, {"_id": 1}) is not None
 
 async def get_idiom_by_catalogue(catalogue: str) -> list[dict]:
-    return idioms_data.find({"catalogue": catalogue})
+    return await idioms_data.find({"catalogue": catalogue}).to_list(length=None)
 
 async def get_idiom_by_comment(comment: str) -> list[dict]:
-    return idioms_data.find({"comment": comment})
+    return await idioms_data.find({"comment": comment}).to_list(length=None)
+
+async def get_idioms_by_catalogue_and_comment(catalogue: list[str], comment: list[str], limit: int) -> list[dict]:
+    # approved idioms in any of the categories that also carry any of the comments
+    query = {"under_review": False}
+    if catalogue:
+        query["catalogue"] = {"$in": catalogue}
+    if comment:
+        query["comment"] = {"$in": comment}
+    projection = {"_id": 0, "image_hash": 1, "image_ext": 1, "tags": 1, "catalogue": 1, "comment": 1}
+    return await idioms_data.find(query, projection).limit(limit).to_list(length=None)
 
 async def get_catalogue_by_image_hash(image_hash: str) -> list[str]:
-    return idioms_data.find_one({"image_hash": image_hash})["catalogue"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["catalogue"]
 
 async def get_comment_by_image_hash(image_hash: str) -> list[str]:
-    return idioms_data.find_one({"image_hash": image_hash})["comment"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["comment"]
 
 async def get_latest_25() -> list[dict]:
-    return idioms_data.find().sort("timestamp", -1).limit(25)
+    return await idioms_data.find().sort("timestamp", -1).limit(25).to_list(length=None)
 
 
 async def get_full_hash_by_prefix(prefix: str) -> list[str] | None:
-    hash_counts = idioms_data.count_documents({"image_hash": {"$regex": f"^{prefix}"}})
-    if hash_counts == 0:
-        return None
-    elif hash_counts == 1:
-        return [idioms_data.find_one({"image_hash": {"$regex": f"^{prefix}"}})["image_hash"]]
-    else:
-        result = []
-        all_hashes = idioms_data.find({"image_hash": {"$regex": f"^{prefix}"}})
-        for hash in all_hashes:
-            result.append(hash["image_hash"])
-        return result
+    if hash_index.hash_index_loaded:
+        result = hash_index.find_by_prefix(prefix)
+        if result:
+            return result
+    # not loaded yet, or inserted by another instance since the index was built
+    result = []
+    async for idiom in idioms_data.find({"image_hash": {"$regex": f"^{re.escape(prefix)}"}}, {"image_hash": 1}):
+        result.append(idiom["image_hash"])
+        if hash_index.hash_index_loaded:
+            hash_index.add_hash(idiom["image_hash"])
+    return result or None
+
+ocr_lsh_task: asyncio.Task | None = None
+
+
+async def load_ocr_lsh_index(batch_size: int = 500) -> int:
+    # each batch is hashed in a thread and inserted on the event loop, approvals made meanwhile land in the same index
+    ocr_lsh.clear_ocr_lsh()
+    cursor = idioms_data.find({"under_review": False}, {"_id": 0, "image_hash": 1, "ocr_text": 1}).batch_size(batch_size)
+    while batch := await cursor.to_list(length=batch_size):
+        new_signatures = await asyncio.to_thread(ocr_lsh.minhash_many, [idiom.get("ocr_text") for idiom in batch])
+        for idiom, signature in zip(batch, new_signatures):
+            ocr_lsh.add_signature(idiom["image_hash"], signature)
+    ocr_lsh.mark_ocr_lsh_loaded()
+    logger.info(f"Loaded {len(ocr_lsh.signatures)} approved OCR texts into the dedup LSH index")
+    return len(ocr_lsh.signatures)
+
+async def load_phash_index() -> int:
+    phashes = dict()
+    async for idiom in idioms_data.find({"phash": {"$type": "string"}}, {"_id": 0, "image_hash": 1, "phash": 1}):
+        phashes[idiom["image_hash"]] = idiom["phash"]
+    phash.load_phash_index(phashes)
+    logger.info(f"Loaded {len(phash.phash_by_hash)} perceptual hashes into the near-duplicate index")
+    return len(phash.phash_by_hash)
+
+async def get_phash_backfill_batch(after_id: str | None, batch_size: int) -> list[dict]:
+    # idioms stored before perceptual hashes were, in _id order from the previous batch
+    query = {"phash": {"$exists": False}}
+    if after_id:
+        query["_id"] = {"$gt": ObjectId(after_id)}
+    cursor = idioms_data.find(query, {"_id": 1, "image_hash": 1, "image_ext": 1}).sort("_id", ASCENDING).limit(batch_size)
+    return await cursor.to_list(length=None)
+
+async def bulk_set_phash(phashes: dict[str, str | None]) -> int:
+    # None marks an image that could not be hashed, so the backfill does not retry it forever
+    if not phashes:
+        return 0
+    result = await idioms_data.bulk_write([
+        UpdateOne({"image_hash": image_hash}, {"$set": {"phash": image_phash}})
+        for image_hash, image_phash in phashes.items()
+    ], ordered=False)
+    for image_hash, image_phash in phashes.items():
+        phash.add_phash(image_hash, image_phash)
+    return result.modified_count
+
+async def load_hash_index() -> int:
+    image_hashes = [idiom["image_hash"] async for idiom in idioms_data.find({}, {"image_hash": 1, "_id": 0})]
+    hash_index.load_hash_index(image_hashes)
+    logger.info(f"Loaded {len(hash_index.sorted_hashes)} image hashes into the prefix index")
+    return len(hash_index.sorted_hashes)
+
+async def get_idioms_by_prefixes(prefixes: list[str]) -> list[dict]:
+    # resolve several short IDs in a single query
+    patterns = [re.compile(f"^{re.escape(prefix)}") for prefix in prefixes]
+    return await idioms_data.find({"image_hash": {"$in": patterns}}, {"image_hash": 1, "image_ext": 1}).to_list(length=None)
 
 async def get_uploader_by_hash(image_hash: str) -> dict:
-    return idioms_data.find_one({"image_hash": image_hash})["uploader"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["uploader"]
+
+counter_projection = {"_id": 0, "under_review": 1, "uploader": 1, "timestamp": 1}
+
+
+def stat_buckets(timestamp: datetime.datetime) -> dict[str, str]:
+    timestamp = timestamp.astimezone(shanghai_tz)
+    iso_year, iso_week, _ = timestamp.isocalendar()
+    return {"all": "all", "week": f"w{iso_year}-{iso_week:02d}", "month": f"m{timestamp.year}-{timestamp.month:02d}"}
+
+
+async def _apply_idiom_counters(idiom: dict, sign: int) -> None:
+    # sign 1 starts counting an idiom in its current state, -1 stops counting it
+    if idiom.get("under_review"):
+        await stats_data.update_one({"_id": "review"}, {"$inc": {"under_review": sign}}, upsert=True)
+        return
+    await stats_data.update_one({"_id": "review"}, {"$inc": {"reviewed": sign}}, upsert=True)
+    uploader = idiom.get("uploader") or {}
+    timestamp = idiom.get("timestamp") or datetime.datetime.now(shanghai_tz)
+    await uploader_stats_data.bulk_write([
+        UpdateOne({"bucket": bucket, "platform": uploader.get("platform"), "uploader_id": uploader.get("id")},
+                  {"$inc": {"count": sign}}, upsert=True)
+        for bucket in stat_buckets(timestamp).values()
+    ], ordered=False)
+
+
+async def reconcile_counters() -> None:
+    # recount everything from the idioms collection, repairs drift from partial failures
+    # corrections are compare-and-set against the counters read before the recount: a counter that
+    # a concurrent $inc moved in the meantime is left alone and repaired on the next run instead
+    review_before = await stats_data.find_one({"_id": "review"}) or {}
+    uploader_before = {
+        (stat["bucket"], stat.get("platform"), stat.get("uploader_id")): (stat["_id"], stat.get("count", 0))
+        async for stat in uploader_stats_data.find({}, {"bucket": 1, "platform": 1, "uploader_id": 1, "count": 1})
+    }
+    counters = {"under_review": 0, "reviewed": 0}
+    uploader_counts: dict[tuple, int] = dict()
+    async for idiom in idioms_data.find({}, counter_projection):
+        if idiom.get("under_review"):
+            counters["under_review"] += 1
+            continue
+        counters["reviewed"] += 1
+        uploader = idiom.get("uploader") or {}
+        timestamp = idiom.get("timestamp") or datetime.datetime.now(shanghai_tz)
+        for bucket in stat_buckets(timestamp).values():
+            key = (bucket, uploader.get("platform"), uploader.get("id"))
+            uploader_counts[key] = uploader_counts.get(key, 0) + 1
+    if not review_before:
+        await stats_data.update_one({"_id": "review"}, {"$setOnInsert": counters}, upsert=True)
+    for field, count in counters.items():
+        if review_before and review_before.get(field) != count:
+            # a missing field matches None, i.e. it is still missing
+            await stats_data.update_one({"_id": "review", field: review_before.get(field)}, {"$set": {field: count}})
+    operations = list()
+    for key, count in uploader_counts.items():
+        if key not in uploader_before:
+            bucket, platform, uploader_id = key
+            operations.append(UpdateOne({"bucket": bucket, "platform": platform, "uploader_id": uploader_id},
+                                        {"$setOnInsert": {"count": count}}, upsert=True))
+        elif uploader_before[key][1] != count:
+            stat_id, count_before = uploader_before[key]
+            operations.append(UpdateOne({"_id": stat_id, "count": count_before}, {"$set": {"count": count}}))
+    # uploaders that no longer have any approved idiom in a bucket
+    operations += [
+        UpdateOne({"_id": stat_id, "count": count_before}, {"$set": {"count": 0}})
+        for key, (stat_id, count_before) in uploader_before.items()
+        if key not in uploader_counts and count_before != 0
+    ]
+    for i in range(0, len(operations), 1000):
+        await uploader_stats_data.bulk_write(operations[i:i + 1000], ordered=False)
+    logger.info(f"Counters reconciled: {counters['reviewed']} reviewed, {counters['under_review']} under review, "
+                f"{len(uploader_counts)} uploader buckets, {len(operations)} corrections")
+
+
+reconcile_task: asyncio.Task | None = None
+
+
+async def reconcile_counters_loop() -> None:
+    # the startup hook has just loaded the hash index, and missing counters are recounted on first read
+    while True:
+        await asyncio.sleep(ei_stats_reconcile_interval)
+        try:
+            await reconcile_counters()
+            # a rebuild also heals prefix index entries whose HASHES_CHANGED broadcast was missed
+            await load_hash_index()
+        except PyMongoError as e:
+            logger.warning(f"Counter reconciliation failed: {e}")
+
 
 # get uploader nickname rank and exclude under_review idioms and platform is not qq
-async def get_uploader_rank() -> list[dict]:
-    return idioms_data.aggregate([
-        {"$match": {"under_review": False, "uploader.platform": {"$eq": "qq"}}},
-        {"$group": {"_id": "$uploader.id", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 10}
-    ])
+async def get_uploader_rank(period: str = "all") -> list[dict]:
+    bucket = stat_buckets(datetime.datetime.now(shanghai_tz))[period]
+    cursor = uploader_stats_data.find({"bucket": bucket, "platform": "qq", "count": {"$gt": 0}}).sort("count", -1).limit(10)
+    return [{"_id": stat["uploader_id"], "count": stat["count"]} async for stat in cursor]
+
+
+# display and workflow fields of an idiom, everything except the bulky ocr_text and _id
+idiom_projection = {"_id": 0, "image_hash": 1, "image_ext": 1, "tags": 1, "uploader": 1, "under_review": 1,
+                    "comment": 1, "catalogue": 1, "timestamp": 1}
+
+
+class IdiomRepository:
+    # create one per command: an identity map so every idiom is read at most once, in a single $in query
+    def __init__(self, projection: dict | None = None) -> None:
+        self.projection = projection or idiom_projection
+        self.records: dict[str, dict | None] = dict()
+
+    async def get(self, image_hash: str) -> dict | None:
+        if image_hash not in self.records:
+            await self.get_many([image_hash])
+        return self.records[image_hash]
+
+    async def get_many(self, image_hashes: list[str]) -> dict[str, dict | None]:
+        missing = [image_hash for image_hash in dict.fromkeys(image_hashes) if image_hash not in self.records]
+        if missing:
+            found = dict()
+            async for idiom in idioms_data.find({"image_hash": {"$in": missing}}, self.projection):
+                found[idiom["image_hash"]] = idiom
+            for image_hash in missing:
+                self.records[image_hash] = found.get(image_hash)
+        return {image_hash: self.records[image_hash] for image_hash in image_hashes}
+
+    def forget(self, image_hash: str) -> None:
+        self.records.pop(image_hash, None)
 
 
 async def get_gm_info(user_id):
     user_id = str(user_id)
-    result: dict = cards_data.find_one({'id': user_id})
+    result: dict = await cards_data.find_one({'id': user_id})
     card: str = result['card'] if result else None
     return card
 
 async def set_gm_info(user_id, gm_info):
     user_id = str(user_id)
-    result = cards_data.update_one(
+    result = await cards_data.update_one(
         {'id': user_id},
         {'$set': {'card': gm_info}},
         upsert=True
@@ -142,28 +616,39 @@ async def set_gm_info(user_id, gm_info):
     return result.modified_count
 
 async def get_random_idiom() -> dict:
-    return idioms_data.aggregate([{"$sample": {"size": 1}}]).next()
+    return (await idioms_data.aggregate([{"$sample": {"size": 1}}]).to_list(length=1))[0]
+
+async def get_approved_filenames() -> list[str]:
+    cursor = idioms_data.find({"under_review": False}, {"_id": 0, "image_hash": 1, "image_ext": 1})
+    return [f"{idiom['image_hash']}.{idiom['image_ext']}" async for idiom in cursor]
+
+async def get_random_idioms(size: int) -> list[dict]:
+    return await idioms_data.aggregate([{"$sample": {"size": size}}, {"$project": {"image_hash": 1, "image_ext": 1}}]).to_list(length=None)
+
+async def get_exts_by_image_hashes(image_hashes: list[str]) -> dict[str, str]:
+    cursor = idioms_data.find({"image_hash": {"$in": image_hashes}}, {"image_hash": 1, "image_ext": 1})
+    return {idiom["image_hash"]: idiom["image_ext"] async for idiom in cursor}
 
 async def get_ocr_text_by_image_hash(image_hash: str) -> list[str]:
-    return idioms_data.find_one({"image_hash": image_hash})["ocr_text"]
+    return (await idioms_data.find_one({"image_hash": image_hash}))["ocr_text"]
 
 async def greylist_incr(user_id:str, platform:str) -> int:
-    return greylist_data.update_one(
+    return (await greylist_data.update_one(
         {"user_id": user_id, "platform": platform},
         {"$inc": {"count": 1}},
         upsert=True
-    ).modified_count
+    )).modified_count
 
 async def add_cate(id: str, alias: list[str]) -> None:
-    cate_data.update_one({"id": id}, {"$set": {"alias": alias}}, upsert=True)
+    await cate_data.update_one({"id": id}, {"$set": {"alias": alias}}, upsert=True)
 
 async def append_cate(id: str, alias: list[str]) -> None:
     # merge new alias into old alias
-    cate_data.update_one({"id": id}, {"$addToSet": {"alias": {"$each": alias}}}, upsert=True)
+    await cate_data.update_one({"id": id}, {"$addToSet": {"alias": {"$each": alias}}}, upsert=True)
 
 async def get_all_alias() -> dict:
     # get all alias in cate and merge them into one dict
     alias = {}
-    for cate in cate_data.find():
+    async for cate in cate_data.find():
         alias[cate["id"]] = cate["alias"]
     return alias
\ No newline at end of file
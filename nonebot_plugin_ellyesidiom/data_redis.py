@@ -1,5 +1,8 @@
 from redis import StrictRedis
+from redis.exceptions import RedisError
 from datetime import datetime
+from nonebot import get_driver
+from nonebot.log import logger
 from .consts import global_config
 
 rd_host = global_config.redis_host
@@ -8,6 +11,9 @@ rd_db = global_config.redis_db
 
 rd = StrictRedis(host=rd_host, port=rd_port, db=rd_db)
 
+# distinct keywords kept in SEARCH_FREQ, the least searched are trimmed past this
+ei_search_freq_max: int = getattr(global_config, "ei_search_freq_max", 10000)
+
 def set_ratelimited(name, time):
     rd.set("RL_"+name, datetime.now().strftime("%m/%d/%Y, %H:%M:%S"), ex=time)
 
@@ -18,4 +24,102 @@ def set_group_name(name):
     rd.set("GROUP_NAME", name)
 
 def get_group_name():
-    return rd.get("GROUP_NAME")
\ No newline at end of file
+    return rd.get("GROUP_NAME")
+
+def record_search(keyword):
+    pipe = rd.pipeline(transaction=False)
+    pipe.zincrby("SEARCH_FREQ", 1, keyword)
+    pipe.zremrangebyrank("SEARCH_FREQ", 0, -ei_search_freq_max - 1)
+    pipe.execute()
+
+def get_top_searches(count):
+    return [keyword.decode("utf-8") for keyword in rd.zrevrange("SEARCH_FREQ", 0, count - 1)]
+
+def pop_random_deck():
+    filename = rd.lpop("RANDOM_DECK")
+    return filename.decode("utf-8") if filename else None
+
+def peek_random_deck(count):
+    return [filename.decode("utf-8") for filename in rd.lrange("RANDOM_DECK", 0, count - 1)]
+
+def get_random_deck_length():
+    return rd.llen("RANDOM_DECK")
+
+def extend_random_deck(filenames):
+    pipe = rd.pipeline()
+    for i in range(0, len(filenames), 1000):
+        pipe.rpush("RANDOM_DECK", *filenames[i:i + 1000])
+    pipe.execute()
+
+def remove_from_random_deck(filename):
+    # a card can sit anywhere in the deck, LREM drops every copy of it
+    return rd.lrem("RANDOM_DECK", 0, filename)
+
+# channel -> handler, registered at import and subscribed together once the bot starts;
+# handlers are called from the pubsub thread with each message
+change_handlers = dict()
+change_listener = None
+
+def start_change_listener():
+    global change_listener
+    if change_listener is not None or not change_handlers:
+        return change_listener
+    pubsub = rd.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(**change_handlers)
+    change_listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+    return change_listener
+
+def publish_hash_change(op, image_hashes):
+    # op is "add" or "remove", the message is "<op>:<hash>,<hash>,..."
+    rd.publish("HASHES_CHANGED", f"{op}:{','.join(image_hashes)}")
+
+def subscribe_hash_changes(handler):
+    change_handlers["HASHES_CHANGED"] = handler
+
+def bump_cate_version():
+    version = rd.incr("CATE_VERSION")
+    rd.publish("CATE_CHANGED", version)
+    return version
+
+def subscribe_cate_changes(handler):
+    change_handlers["CATE_CHANGED"] = handler
+
+# INCR and PUBLISH in a single round trip, the message is "<origin>:<generation>"
+_bump_idiom_generation = rd.register_script("""
+local generation = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], ARGV[2] .. ':' .. generation)
+return generation
+""")
+
+def bump_idiom_generation(origin: str):
+    # any change to the searchable corpus, every other instance drops its cached query results
+    return _bump_idiom_generation(keys=["IDIOM_GENERATION"], args=["IDIOM_CHANGED", origin])
+
+def subscribe_idiom_changes(handler):
+    change_handlers["IDIOM_CHANGED"] = handler
+
+def get_refilter_checkpoint():
+    checkpoint = rd.get("REFILTER_OCR_CHECKPOINT")
+    return checkpoint.decode("utf-8") if checkpoint else None
+
+def set_refilter_checkpoint(last_id):
+    rd.set("REFILTER_OCR_CHECKPOINT", last_id)
+
+def get_refilter_match():
+    # substring an interrupted run was limited to, "" when it covered the whole corpus
+    match = rd.get("REFILTER_OCR_MATCH")
+    return match.decode("utf-8") if match is not None else None
+
+def set_refilter_match(match):
+    rd.set("REFILTER_OCR_MATCH", match)
+
+def clear_refilter_checkpoint():
+    rd.delete("REFILTER_OCR_CHECKPOINT", "REFILTER_OCR_MATCH")
+
+@get_driver().on_startup
+async def _():
+    # a redis outage must not keep the bot from starting, the caches fall back to their TTLs
+    try:
+        start_change_listener()
+    except RedisError as e:
+        logger.warning(f"Failed to subscribe to change notifications, relying on cache TTLs: {e}")
@@ -1,68 +1,74 @@
-from .data_mongo import get_latest_25, get_idiom_by_image_hash
+import asyncio
+
+from .data_mongo import get_latest_25, IdiomRepository
 from .data_mongo import get_under_review_idioms
-from .cat_checker import id_to_ep_alias
+from .cat_checker import ids_to_ep_aliases
 from .data_es import search_idiom
-from .consts import global_config
+from .data_redis import record_search
+from .query_cache import query_cache_key, cached_query
+from .storage import storage_backend
+from .thumbnail import get_image_urls
+from .storage_backends import LocalStorageBackend
 
-from fastapi import FastAPI, APIRouter
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi.responses import JSONResponse, FileResponse
 from nonebot import get_app
 from nonebot.log import logger
 
-ei_img_storage_bucket = global_config.ei_img_storage_bucket
-ei_img_storage_region = global_config.ei_img_storage_region
-
 app: FastAPI = get_app()
 
 router = APIRouter()
 
 @router.get("/api/index")
 async def index():
-    mg_data = await get_latest_25()
+    mg_data = list(await get_latest_25())
+    image_urls = await asyncio.gather(*[get_image_urls(data["image_hash"], data["image_ext"]) for data in mg_data])
     payload = []
-    for data in mg_data:
+    for data, urls in zip(mg_data, image_urls):
         temp_dict = {}
         if "tags" in data and data["tags"]:
             temp_dict["title"] = " ".join(data["tags"])
         else:
             temp_dict["title"] = ""
         subtitle_str = ""
-        cat_name = list()
-        for cat in data["catalogue"]:
-            cat_name.append(await id_to_ep_alias(cat))
-        cat_name = " ".join(cat_name)
+        cat_name = " ".join(await ids_to_ep_aliases(data["catalogue"]))
         com_str = " ".join(data["comment"]) or "无"
         subtitle_str = f"备注:{com_str} 分类:{cat_name}"
         temp_dict["subtitle"] = subtitle_str
-        image_url = data["image_hash"] + "." + data["image_ext"]
-        image_url = f"https://{ei_img_storage_bucket}.cos.{ei_img_storage_region}.myqcloud.com/" + image_url
-        temp_dict["img"] = image_url
+        temp_dict.update(urls)
         payload.append(temp_dict)
     return JSONResponse(payload)
 
 
 @router.get("/api/search")
 async def search(keyword: str):
+    record_search(keyword)
+    payload = await cached_query(query_cache_key("api_search", keyword), lambda: _search_payload(keyword))
+    if payload is None:
+        return JSONResponse({"status": "no result"})
+    return JSONResponse(payload)
+
+
+async def _search_payload(keyword: str) -> list[dict] | None:
     search_res = await search_idiom(keyword)
     search_count = search_res["hits"]["total"]["value"]
     if search_count == 0:
-        return JSONResponse({"status": "no result"})
+        return None
     search_res = search_res["hits"]["hits"]
+    # every hit is resolved by one $in query, hits whose idiom is gone from mongo are dropped
+    records = await IdiomRepository().get_many([data["_source"]["image_hash"] for data in search_res])
+    mg_data = [data for data in records.values() if data is not None]
+    image_urls = await asyncio.gather(*[get_image_urls(data["image_hash"], data["image_ext"]) for data in mg_data])
     payload = []
-    for data in search_res:
-        data_hash = data["_source"]["image_hash"]
-        data = await get_idiom_by_image_hash(data_hash)
+    for data, urls in zip(mg_data, image_urls):
         temp_dict = {}
         if "tags" in data and data["tags"]:
             temp_dict["title"] = " ".join(data["tags"])
         else:
             temp_dict["title"] = ""
         subtitle_str = ""
-        cat_name = list()
         if "catalogue" in data and data["catalogue"]:
-            for cat in data["catalogue"]:
-                cat_name.append(await id_to_ep_alias(cat))
-            cat_name = " ".join(cat_name)
+            cat_name = " ".join(await ids_to_ep_aliases(data["catalogue"]))
         else:
             cat_name = "怡宝"
         if "comment" in data and data["comment"]:
@@ -71,11 +77,9 @@ async def search(keyword: str):
             com_str = "无"
         subtitle_str = f"备注:{com_str} 分类:{cat_name}"
         temp_dict["subtitle"] = subtitle_str
-        image_url = data["image_hash"] + "." + data["image_ext"]
-        image_url = f"https://{ei_img_storage_bucket}.cos.{ei_img_storage_region}.myqcloud.com/" + image_url
-        temp_dict["img"] = image_url
+        temp_dict.update(urls)
         payload.append(temp_dict)
-    return JSONResponse(payload)
+    return payload
 
 @router.post("/api/admin_auth")
 async def admin_auth():
@@ -87,18 +91,30 @@ async def is_admin():
 
 @router.get("/api/get_review_list")
 async def get_review_list():
-    data = await get_under_review_idioms()
+    data = list(await get_under_review_idioms())
+    image_urls = await asyncio.gather(*[get_image_urls(d["image_hash"], d["image_ext"]) for d in data])
     payload = []
-    for d in data:
-        temp_dict = {}
-        temp_dict["img"] = f"https://{ei_img_storage_bucket}.cos.{ei_img_storage_region}.myqcloud.com/" + d["image_hash"] + "." + d["image_ext"]
+    for d, urls in zip(data, image_urls):
+        temp_dict = dict(urls)
         temp_dict["tags"] = d["tags"]
         temp_dict["comment"] = d["comment"]
         temp_dict["catalogue"] = d["catalogue"]
         payload.append(temp_dict)
     return JSONResponse(payload)
 
-    
+
+# images are only served by the bot itself when they are kept on local disk
+if isinstance(storage_backend, LocalStorageBackend):
+    @router.get("/api/image/{key:path}")
+    async def get_image(key: str):
+        try:
+            path = storage_backend.path(key)
+        except ValueError:
+            raise HTTPException(status_code=404)
+        if not storage_backend.exists(key):
+            raise HTTPException(status_code=404)
+        return FileResponse(path)
+
 
 app.include_router(router)
 logger.info("EllyeHub API Server Started")
\ No newline at end of file
@@ -0,0 +1,50 @@
+from bisect import bisect_left
+
+# every known image hash in sorted order, prefix lookups are two binary searches
+sorted_hashes: list[str] = list()
+hash_index_loaded = False
+
+
+def load_hash_index(image_hashes) -> None:
+    global hash_index_loaded
+    sorted_hashes[:] = sorted(set(image_hashes))
+    hash_index_loaded = True
+
+
+def add_hash(image_hash: str) -> None:
+    pos = bisect_left(sorted_hashes, image_hash)
+    if pos == len(sorted_hashes) or sorted_hashes[pos] != image_hash:
+        sorted_hashes.insert(pos, image_hash)
+
+
+def remove_hash(image_hash: str) -> None:
+    pos = bisect_left(sorted_hashes, image_hash)
+    if pos < len(sorted_hashes) and sorted_hashes[pos] == image_hash:
+        del sorted_hashes[pos]
+
+
+def find_by_prefix(prefix: str) -> list[str]:
+    lo = bisect_left(sorted_hashes, prefix)
+    hi = bisect_left(sorted_hashes, prefix + "\U0010ffff", lo)
+    return sorted_hashes[lo:hi]
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def shortest_unique_prefix(image_hash: str, min_length: int = 6) -> str:
+    # only the sorted neighbours can share a longer prefix than any other hash
+    pos = bisect_left(sorted_hashes, image_hash)
+    length = 0
+    if pos > 0:
+        length = max(length, _common_prefix_length(image_hash, sorted_hashes[pos - 1]))
+    next_pos = pos + 1 if pos < len(sorted_hashes) and sorted_hashes[pos] == image_hash else pos
+    if next_pos < len(sorted_hashes):
+        length = max(length, _common_prefix_length(image_hash, sorted_hashes[next_pos]))
+    return image_hash[:max(min_length, length + 1)]
@@ -25,23 +25,23 @@ async def clean_ocr_text(ocr_text: list[dict]) -> list[dict]:
     text_blacklist_partial = ["问怡宝一律", "问怡宝回答是", "问怡宝绿帽", "Hoshino", "星乃花园#", "人在线", "相亲相爱", "番灵装", "怡甸园", "tthamy", "清华大学怡国校区", "怡群清华分部", "paradise"]
     text_blacklist_fullmatch = ["发送", "取消", "<返回"]
     text_blacklist_regex = [r"^(上午|下午)?([0-1]?[0-9]|2[0-3]):[0-5][0-9]$", r"Hoshino(.*)花园", r"^LV(.*)?(群主|管理员)$", r"^\[.*]", r"^【.*】"]
-    group_name = get_group_name().decode("utf-8")
-    group_name = group_name[:5]
-    text_blacklist_partial.extend([group_name])
+    group_name = get_group_name()
+    if group_name:
+        text_blacklist_partial.append(group_name.decode("utf-8")[:5])
 
     cleaned_ocr_text = list()
     for i in ocr_text:
         if any(blacklisted_text in i["text"] for blacklisted_text in text_blacklist_partial):
-            print("Partial match:", i["text"])
+            logger.debug(f"Partial match: {i['text']}")
             continue
         if i["text"] in text_blacklist_fullmatch:
-            print("Full match:", i["text"])
+            logger.debug(f"Full match: {i['text']}")
             continue
         if len(i["text"]) == 1:
-            print("Single character:", i["text"])
+            logger.debug(f"Single character: {i['text']}")
             continue
         if any(re.match(regex, i["text"], re.IGNORECASE) for regex in text_blacklist_regex):
-            print("Regex match:", i["text"])
+            logger.debug(f"Regex match: {i['text']}")
             continue
         cleaned_ocr_text.append(i)
     return cleaned_ocr_text
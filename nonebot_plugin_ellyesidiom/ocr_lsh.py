@@ -0,0 +1,103 @@
+import random
+import unicodedata
+
+from xxhash import xxh32_intdigest
+
+from .consts import global_config
+
+# in-process MinHash/LSH index over the OCR text of approved idioms, check_dedup asks it before ES
+ei_dedup_lsh: bool = getattr(global_config, "ei_dedup_lsh", False)
+ei_dedup_lsh_threshold: float = getattr(global_config, "ei_dedup_lsh_threshold", 0.6)
+
+SHINGLE_SIZE = 3
+# 16 bands of 4 rows: texts with a jaccard similarity around 0.5 and up collide in at least one band
+NUM_BANDS = 16
+BAND_ROWS = 4
+NUM_PERM = NUM_BANDS * BAND_ROWS
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0x5eed)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+signatures: dict[str, tuple[int, ...]] = dict()
+bands: list[dict[tuple[int, ...], set[str]]] = [dict() for _ in range(NUM_BANDS)]
+ocr_lsh_loaded = False
+
+
+def normalize_ocr_text(ocr_text: list[str] | None) -> str:
+    # case folded, with whitespace, punctuation and control characters dropped
+    if not ocr_text:
+        return ""
+    text = unicodedata.normalize("NFKC", "".join(ocr_text)).casefold()
+    return "".join(ch for ch in text if unicodedata.category(ch)[0] not in ("P", "Z", "C"))
+
+
+def minhash(ocr_text: list[str] | None) -> tuple[int, ...] | None:
+    text = normalize_ocr_text(ocr_text)
+    if not text:
+        return None
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))}
+    hashes = [xxh32_intdigest(shingle.encode("utf-8")) for shingle in shingles]
+    return tuple(min([(a * h + b) % _PRIME for h in hashes]) for a, b in _PERMUTATIONS)
+
+
+def minhash_many(ocr_texts: list[list[str] | None]) -> list[tuple[int, ...] | None]:
+    # blocking, run it in a thread; the index itself is only touched from the event loop
+    return [minhash(ocr_text) for ocr_text in ocr_texts]
+
+
+def _band_keys(signature: tuple[int, ...]) -> list[tuple[int, ...]]:
+    return [signature[i * BAND_ROWS:(i + 1) * BAND_ROWS] for i in range(NUM_BANDS)]
+
+
+def clear_ocr_lsh() -> None:
+    global ocr_lsh_loaded
+    signatures.clear()
+    for band in bands:
+        band.clear()
+    ocr_lsh_loaded = False
+
+
+def mark_ocr_lsh_loaded() -> None:
+    global ocr_lsh_loaded
+    ocr_lsh_loaded = True
+
+
+def remove_ocr_text(image_hash: str) -> None:
+    signature = signatures.pop(image_hash, None)
+    if signature is None:
+        return
+    for band, key in zip(bands, _band_keys(signature)):
+        bucket = band.get(key)
+        if bucket is not None:
+            bucket.discard(image_hash)
+            if not bucket:
+                del band[key]
+
+
+def add_signature(image_hash: str, signature: tuple[int, ...] | None) -> None:
+    remove_ocr_text(image_hash)
+    if signature is None:
+        return
+    signatures[image_hash] = signature
+    for band, key in zip(bands, _band_keys(signature)):
+        band.setdefault(key, set()).add(image_hash)
+
+
+def find_similar(signature: tuple[int, ...] | None, exclude: str | None = None,
+                 threshold: float | None = None) -> list[tuple[str, float]]:
+    # candidates sharing a band, ranked by the estimated jaccard similarity of their shingles
+    threshold = ei_dedup_lsh_threshold if threshold is None else threshold
+    if signature is None:
+        return []
+    candidates = set()
+    for band, key in zip(bands, _band_keys(signature)):
+        candidates.update(band.get(key, ()))
+    candidates.discard(exclude)
+    result = list()
+    for image_hash in candidates:
+        other = signatures[image_hash]
+        similarity = sum(x == y for x, y in zip(signature, other)) / NUM_PERM
+        if similarity >= threshold:
+            result.append((image_hash, similarity))
+    result.sort(key=lambda item: item[1], reverse=True)
+    return result
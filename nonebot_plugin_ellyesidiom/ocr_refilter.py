@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from .data_es import bulk_update_ocr_text as es_bulk_update_ocr_text
+from .data_mongo import get_ocr_text_batch, bulk_update_ocr_text, count_idioms
+from .data_redis import get_refilter_checkpoint, set_refilter_checkpoint, clear_refilter_checkpoint
+from .data_redis import get_refilter_match, set_refilter_match
+from .ocr import clean_ocr_text_pure_str
+
+# only idioms whose OCR text contains this are re-filtered unless a whole corpus run is asked for
+default_refilter_match = "怡春院"
+
+refilter_task: asyncio.Task | None = None
+refilter_progress: dict = dict()
+
+
+def refilter_running() -> bool:
+    return refilter_task is not None and not refilter_task.done()
+
+
+def format_refilter_progress() -> str:
+    if not refilter_progress:
+        return "重过滤准备中。"
+    elapsed = time.monotonic() - refilter_progress["started_at"]
+    rate = refilter_progress["processed"] / elapsed if elapsed else 0
+    return (f"重过滤进度：{refilter_progress['processed']}/{refilter_progress['total']}，"
+            f"修改{refilter_progress['changed']}条，{rate:.1f}条/秒")
+
+
+async def run_ocr_refilter(report=None, match: str | None = default_refilter_match,
+                           batch_size: int = 500, report_interval: float = 60) -> dict:
+    # report is an optional coroutine function taking a progress message for the admin,
+    # match limits the run to idioms whose OCR text contains it, None re-filters everything
+    last_id = get_refilter_checkpoint()
+    set_refilter_match(match or "")
+    refilter_progress.clear()
+    refilter_progress.update({"processed": 0, "changed": 0, "total": await count_idioms(),
+                              "resumed_from": last_id, "started_at": time.monotonic()})
+    last_report = time.monotonic()
+    while True:
+        batch = await get_ocr_text_batch(last_id, batch_size)
+        if not batch:
+            break
+        changed = dict()
+        for idiom in batch:
+            ocr_text = idiom.get("ocr_text") or []
+            if match and match not in str(ocr_text):
+                continue
+            new_ocr_text = await clean_ocr_text_pure_str(ocr_text)
+            if new_ocr_text != ocr_text:
+                changed[idiom["image_hash"]] = new_ocr_text
+        await bulk_update_ocr_text(changed)
+        await es_bulk_update_ocr_text(changed)
+        last_id = str(batch[-1]["_id"])
+        # the checkpoint is only moved once both stores have the batch
+        set_refilter_checkpoint(last_id)
+        refilter_progress["processed"] += len(batch)
+        refilter_progress["changed"] += len(changed)
+        if time.monotonic() - last_report > report_interval:
+            last_report = time.monotonic()
+            logger.info(format_refilter_progress())
+            if report:
+                await report(format_refilter_progress())
+    clear_refilter_checkpoint()
+    logger.info("OCR refilter finished. " + format_refilter_progress())
+    if report:
+        await report("重过滤完成。" + format_refilter_progress())
+    return refilter_progress
+
+
+def interrupted_refilter_match() -> str | None:
+    # the scope an interrupted run was started with, runs from before it was stored used the default
+    match = get_refilter_match()
+    return default_refilter_match if match is None else match or None
+
+
+async def _run_ocr_refilter_reporting_errors(report, match: str | None) -> dict | None:
+    try:
+        return await run_ocr_refilter(report, match)
+    except Exception as e:
+        # the checkpoint is left in place, so the next run picks up from the last finished batch
+        logger.exception("OCR refilter failed")
+        if report:
+            try:
+                await report(f"重过滤失败：{e!r}，再次发送命令可从断点继续。" + format_refilter_progress())
+            except Exception:
+                logger.exception("Failed to report the OCR refilter failure")
+        return None
+
+
+def start_ocr_refilter(report=None, match: str | None = default_refilter_match) -> bool:
+    global refilter_task
+    if refilter_running():
+        return False
+    refilter_task = asyncio.create_task(_run_ocr_refilter_reporting_errors(report, match))
+    return True
+
+
+@get_driver().on_startup
+async def _():
+    # pick up a run that was interrupted by a restart
+    if get_refilter_checkpoint():
+        logger.info("Resuming interrupted OCR refilter")
+        start_ocr_refilter(match=interrupted_refilter_match())
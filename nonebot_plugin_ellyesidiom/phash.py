@@ -0,0 +1,120 @@
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError
+
+from .consts import global_config
+
+# perceptual hashes of every idiom image, upload_image rejects near-duplicates before paying for OCR
+ei_phash_dedup: bool = getattr(global_config, "ei_phash_dedup", True)
+ei_phash_max_distance: int = getattr(global_config, "ei_phash_max_distance", 10)
+
+# 16x16 difference hash, 256 bits: chat screenshots look alike at the usual 8x8
+PHASH_SIZE = 16
+PHASH_HEX_LENGTH = PHASH_SIZE * PHASH_SIZE // 4
+
+
+def image_phash(image_bytes: bytes) -> str | None:
+    # blocking, run it in a thread
+    try:
+        image = Image.open(BytesIO(image_bytes))
+        image.seek(0)
+        image = image.convert("L").resize((PHASH_SIZE + 1, PHASH_SIZE), Image.LANCZOS)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        return None
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(PHASH_SIZE):
+        offset = row * (PHASH_SIZE + 1)
+        for col in range(PHASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return f"{value:0{PHASH_HEX_LENGTH}x}"
+
+
+class BKTree:
+    # metric tree over hamming distance, each node holds every image sharing its exact hash
+    def __init__(self) -> None:
+        self.root: list | None = None
+
+    def add(self, value: int, image_hash: str) -> None:
+        if self.root is None:
+            self.root = [value, {image_hash}, dict()]
+            return
+        node = self.root
+        while True:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].add(image_hash)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, {image_hash}, dict()]
+                return
+            node = child
+
+    def discard(self, value: int, image_hash: str) -> None:
+        # nodes are never unlinked, an emptied node just stops matching
+        node = self.root
+        while node is not None:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].discard(image_hash)
+                return
+            node = node[2].get(distance)
+
+    def search(self, value: int, max_distance: int) -> list[tuple[str, int]]:
+        result = list()
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (node[0] ^ value).bit_count()
+            if distance <= max_distance:
+                result.extend((image_hash, distance) for image_hash in node[1])
+            # triangle inequality: only children within max_distance of this distance can match
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return result
+
+
+phash_tree = BKTree()
+phash_by_hash: dict[str, int] = dict()
+phash_index_loaded = False
+
+
+def load_phash_index(phashes: dict[str, str]) -> None:
+    global phash_tree, phash_index_loaded
+    tree = BKTree()
+    by_hash = dict()
+    for image_hash, phash in phashes.items():
+        if phash and len(phash) == PHASH_HEX_LENGTH:
+            value = int(phash, 16)
+            tree.add(value, image_hash)
+            by_hash[image_hash] = value
+    phash_tree = tree
+    phash_by_hash.clear()
+    phash_by_hash.update(by_hash)
+    phash_index_loaded = True
+
+
+def add_phash(image_hash: str, phash: str | None) -> None:
+    if not phash or len(phash) != PHASH_HEX_LENGTH:
+        return
+    remove_phash(image_hash)
+    value = int(phash, 16)
+    phash_tree.add(value, image_hash)
+    phash_by_hash[image_hash] = value
+
+
+def remove_phash(image_hash: str) -> None:
+    value = phash_by_hash.pop(image_hash, None)
+    if value is not None:
+        phash_tree.discard(value, image_hash)
+
+
+def find_near_duplicates(phash: str | None, max_distance: int | None = None) -> list[tuple[str, int]]:
+    if not phash or len(phash) != PHASH_HEX_LENGTH:
+        return []
+    max_distance = ei_phash_max_distance if max_distance is None else max_distance
+    result = phash_tree.search(int(phash, 16), max_distance)
+    result.sort(key=lambda item: item[1])
+    return result
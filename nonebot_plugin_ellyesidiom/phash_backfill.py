@@ -0,0 +1,58 @@
+import asyncio
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from .data_mongo import get_phash_backfill_batch, bulk_set_phash
+from .phash import image_phash
+from .storage import storage_backend, run_in_storage_pool
+
+backfill_task: asyncio.Task | None = None
+
+
+async def _phash_of(filename: str) -> tuple[bool, str | None]:
+    # straight from the backend, a corpus walk must not evict the hot images from the local cache
+    try:
+        image_bytes = await run_in_storage_pool(storage_backend.get, filename)
+    except Exception as e:
+        logger.warning(f"Failed to download {filename} for phash backfill: {e!r}")
+        return False, None
+    if image_bytes is None:
+        return False, None
+    try:
+        return True, await asyncio.to_thread(image_phash, image_bytes)
+    except Exception as e:
+        # e.g. PIL's DecompressionBombError, one bad image must not end the walk
+        logger.warning(f"Failed to hash {filename}: {e!r}")
+        return True, None
+
+
+async def backfill_phashes(batch_size: int = 100) -> int:
+    # idioms without a phash field are walked once per run, images that fail to download are retried
+    # on the next run, images that download but cannot be hashed are stored as None
+    count = 0
+    last_id = None
+    while True:
+        batch = await get_phash_backfill_batch(last_id, batch_size)
+        if not batch:
+            break
+        results = await asyncio.gather(*[_phash_of(f"{idiom['image_hash']}.{idiom['image_ext']}") for idiom in batch])
+        await bulk_set_phash({idiom["image_hash"]: result for idiom, (downloaded, result) in zip(batch, results) if downloaded})
+        last_id = str(batch[-1]["_id"])
+        count += len(batch)
+    if count:
+        logger.info(f"Backfilled phash for {count} idioms")
+    return count
+
+
+async def _backfill_phashes_logging_errors() -> None:
+    try:
+        await backfill_phashes()
+    except Exception:
+        logger.exception("Phash backfill failed, it resumes on the next start")
+
+
+@get_driver().on_startup
+async def _():
+    global backfill_task
+    backfill_task = asyncio.create_task(_backfill_phashes_logging_errors())
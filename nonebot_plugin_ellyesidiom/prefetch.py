@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from .cache import cache_contains, ei_img_cache_max_bytes
+from .consts import global_config
+from .data_es import search_idiom
+from .data_mongo import get_latest_25, get_random_idioms, get_exts_by_image_hashes
+from .data_redis import get_top_searches
+from .storage import ei_img_storage_download
+
+ei_prefetch_interval: int = getattr(global_config, "ei_prefetch_interval", 3600)
+ei_prefetch_concurrency: int = getattr(global_config, "ei_prefetch_concurrency", 4)
+ei_prefetch_random_count: int = getattr(global_config, "ei_prefetch_random_count", 20)
+ei_prefetch_search_count: int = getattr(global_config, "ei_prefetch_search_count", 10)
+# share of the cache budget warming may fill, so it never evicts everything users just read
+ei_prefetch_budget_ratio: float = getattr(global_config, "ei_prefetch_budget_ratio", 0.5)
+
+last_prefetch_report: dict = dict()
+prefetch_task: asyncio.Task | None = None
+
+
+async def warm_cache(filenames: list[str]) -> dict:
+    start = time.perf_counter()
+    budget = int(ei_img_cache_max_bytes * ei_prefetch_budget_ratio)
+    semaphore = asyncio.Semaphore(ei_prefetch_concurrency)
+    report = {"warmed": 0, "cached": 0, "failed": 0, "skipped": 0, "bytes": 0}
+
+    async def warm(filename: str) -> None:
+        async with semaphore:
+            if report["bytes"] >= budget:
+                report["skipped"] += 1
+                return
+            if cache_contains(filename):
+                report["cached"] += 1
+                return
+            image_bytes = await ei_img_storage_download(filename)
+            if image_bytes is None:
+                report["failed"] += 1
+                return
+            report["warmed"] += 1
+            report["bytes"] += len(image_bytes)
+
+    await asyncio.gather(*[warm(filename) for filename in dict.fromkeys(filenames)])
+    report["elapsed"] = time.perf_counter() - start
+    return report
+
+
+async def collect_hot_filenames() -> list[str]:
+    filenames = list()
+    for idiom in await get_latest_25():
+        filenames.append(f"{idiom['image_hash']}.{idiom['image_ext']}")
+    for idiom in await get_random_idioms(ei_prefetch_random_count):
+        filenames.append(f"{idiom['image_hash']}.{idiom['image_ext']}")
+    search_hashes = list()
+    for keyword in get_top_searches(ei_prefetch_search_count):
+        result = await search_idiom(keyword)
+        search_hashes.extend(hit["_source"]["image_hash"] for hit in result["hits"]["hits"][:5])
+    if search_hashes:
+        for image_hash, image_ext in (await get_exts_by_image_hashes(search_hashes)).items():
+            filenames.append(f"{image_hash}.{image_ext}")
+    return filenames
+
+
+async def prefetch_hot_images() -> dict:
+    filenames = await collect_hot_filenames()
+    report = await warm_cache(filenames)
+    report["finished_at"] = time.time()
+    last_prefetch_report.clear()
+    last_prefetch_report.update(report)
+    logger.info(f"Image cache warmed: {report['warmed']} fetched ({report['bytes']} bytes), "
+                f"{report['cached']} already cached, {report['failed']} failed, {report['skipped']} over budget, "
+                f"took {report['elapsed']:.2f}s")
+    return report
+
+
+async def prefetch_loop() -> None:
+    while True:
+        try:
+            await prefetch_hot_images()
+        except Exception as e:
+            logger.warning(f"Image cache warming failed: {e}")
+        await asyncio.sleep(ei_prefetch_interval)
+
+
+@get_driver().on_startup
+async def _():
+    global prefetch_task
+    prefetch_task = asyncio.create_task(prefetch_loop())
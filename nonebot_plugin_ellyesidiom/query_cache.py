@@ -0,0 +1,108 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+
+from nonebot.log import logger
+
+from .consts import global_config
+from .data_redis import bump_idiom_generation, subscribe_idiom_changes
+
+ei_query_cache_ttl: int = getattr(global_config, "ei_query_cache_ttl", 300)
+ei_query_cache_size: int = getattr(global_config, "ei_query_cache_size", 512)
+
+# normalized query -> (stored at, generation, result), ordered from least to most recently used
+query_cache: OrderedDict[tuple, tuple[float, int, object]] = OrderedDict()
+query_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "invalidations": 0}
+# bumped by every corpus change, entries from an older generation are never served
+query_generation = 0
+
+
+# tags the IDIOM_CHANGED messages this instance publishes, so it does not count its own changes twice
+instance_id = uuid.uuid4().hex
+
+
+def expire_query_cache() -> None:
+    # local only, safe to call from the pubsub thread since it just moves the counter
+    global query_generation
+    query_generation += 1
+    query_cache_stats["invalidations"] += 1
+
+
+def _on_idiom_changed(message) -> None:
+    data = message["data"]
+    origin = (data.decode("utf-8") if isinstance(data, bytes) else str(data)).split(":", 1)[0]
+    if origin != instance_id:
+        expire_query_cache()
+
+
+subscribe_idiom_changes(_on_idiom_changed)
+
+
+def _log_broadcast_failure(future) -> None:
+    if future.exception() is not None:
+        logger.warning(f"Failed to broadcast query cache invalidation: {future.exception()}")
+
+
+def invalidate_query_cache() -> None:
+    # best effort: the write that triggered this has already happened, a redis outage must not fail it.
+    # other instances are told off the event loop, their entries still expire by TTL if it is lost
+    expire_query_cache()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is None:
+        try:
+            bump_idiom_generation(instance_id)
+        except Exception as e:
+            logger.warning(f"Failed to broadcast query cache invalidation: {e}")
+        return
+    loop.run_in_executor(None, bump_idiom_generation, instance_id).add_done_callback(_log_broadcast_failure)
+
+
+def query_cache_key(*parts) -> tuple:
+    # lists are order and duplicate insensitive, so cat=a cat=b and cat=b cat=a share an entry
+    normalized = list()
+    for part in parts:
+        if isinstance(part, (list, tuple, set)):
+            normalized.append(tuple(sorted(set(part))))
+        elif isinstance(part, str):
+            normalized.append(part.strip())
+        else:
+            normalized.append(part)
+    return tuple(normalized)
+
+
+async def cached_query(key: tuple, loader):
+    # loader is a coroutine function producing the result, it must not be mutated by callers
+    entry = query_cache.get(key)
+    if entry is not None:
+        stored_at, generation, result = entry
+        if generation == query_generation and time.monotonic() - stored_at < ei_query_cache_ttl:
+            query_cache.move_to_end(key)
+            query_cache_stats["hits"] += 1
+            return result
+        del query_cache[key]
+        query_cache_stats["expired"] += 1
+    query_cache_stats["misses"] += 1
+    generation = query_generation
+    result = await loader()
+    # a change that landed while loading makes this result stale already
+    if generation == query_generation:
+        query_cache[key] = (time.monotonic(), generation, result)
+        query_cache.move_to_end(key)
+        while len(query_cache) > ei_query_cache_size:
+            query_cache.popitem(last=False)
+    return result
+
+
+def get_query_cache_stats() -> dict:
+    lookups = query_cache_stats["hits"] + query_cache_stats["misses"]
+    return {
+        **query_cache_stats,
+        "entries": len(query_cache),
+        "max_entries": ei_query_cache_size,
+        "generation": query_generation,
+        "hit_ratio": query_cache_stats["hits"] / lookups if lookups else 0.0,
+    }
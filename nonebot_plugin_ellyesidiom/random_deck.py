@@ -0,0 +1,63 @@
+import asyncio
+import random
+
+from nonebot import get_driver
+from nonebot.log import logger
+
+from .consts import global_config
+from .data_mongo import get_approved_filenames
+from .data_redis import pop_random_deck, peek_random_deck, get_random_deck_length, extend_random_deck
+from .prefetch import warm_cache
+from .storage import ei_img_storage_download
+
+ei_random_prefetch_count: int = getattr(global_config, "ei_random_prefetch_count", 3)
+# append the next shuffled deck once this few cards are left, so a poke never waits for a refill
+ei_random_deck_low_water: int = getattr(global_config, "ei_random_deck_low_water", 10)
+
+refill_lock = asyncio.Lock()
+background_tasks: set[asyncio.Task] = set()
+
+
+def _run_in_background(coro) -> None:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def refill_random_deck() -> int:
+    async with refill_lock:
+        length = get_random_deck_length()
+        if length >= ei_random_deck_low_water:
+            return 0
+        # the cards still queued are drawn first, leaving them out of the new shuffle keeps them
+        # from coming up again a few draws later
+        remaining = set(peek_random_deck(length)) if length else set()
+        filenames = [filename for filename in await get_approved_filenames() if filename not in remaining]
+        random.shuffle(filenames)
+        if filenames:
+            extend_random_deck(filenames)
+        logger.info(f"Random idiom deck refilled with {len(filenames)} images")
+        return len(filenames)
+
+
+async def draw_random_idiom() -> bytes | None:
+    # cards of idioms deleted since the deck was shuffled fail to download and are skipped
+    for _ in range(5):
+        filename = pop_random_deck()
+        if filename is None:
+            await refill_random_deck()
+            filename = pop_random_deck()
+            if filename is None:
+                return None
+        if get_random_deck_length() < ei_random_deck_low_water and not refill_lock.locked():
+            _run_in_background(refill_random_deck())
+        _run_in_background(warm_cache(peek_random_deck(ei_random_prefetch_count)))
+        image_bytes = await ei_img_storage_download(filename)
+        if image_bytes is not None:
+            return image_bytes
+    return None
+
+
+@get_driver().on_startup
+async def _():
+    _run_in_background(refill_random_deck())
@@ -1,92 +1,89 @@
-import os
-
-from qcloud_cos import CosConfig
-from qcloud_cos import CosS3Client
-from qcloud_cos import CosServiceError
-from qcloud_cos import CosClientError
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
+from .cache import cache_get, cache_put, cache_remove
 from .consts import global_config
+from .storage_backends import StorageBackend, CosStorageBackend, LocalStorageBackend
+
+ei_img_storage_backend: str = getattr(global_config, "ei_img_storage_backend", "cos")
+ei_img_storage_workers: int = getattr(global_config, "ei_img_storage_workers", 8)
+ei_img_storage_max_inflight: int = getattr(global_config, "ei_img_storage_max_inflight", 16)
+
+
+def create_storage_backend() -> StorageBackend:
+    match ei_img_storage_backend:
+        case "local":
+            return LocalStorageBackend(global_config.ei_img_storage_local_dir,
+                                       getattr(global_config, "ei_img_storage_local_url_prefix", "/api/image/"))
+        case "cos":
+            return CosStorageBackend(global_config.ei_img_storage_bucket, global_config.ei_img_storage_region,
+                                     global_config.ei_img_storage_id, global_config.ei_img_storage_key,
+                                     pool_size=ei_img_storage_workers)
+        case _:
+            raise ValueError(f"Unknown ei_img_storage_backend: {ei_img_storage_backend}")
+
+
+storage_backend = create_storage_backend()
+
+# backends are blocking, run every transfer in a bounded pool instead of on the event loop
+storage_executor = ThreadPoolExecutor(max_workers=ei_img_storage_workers, thread_name_prefix="ei_img_storage")
+storage_inflight = asyncio.Semaphore(ei_img_storage_max_inflight)
+
+# filename -> fetch currently in flight, concurrent cache misses on the same file share it
+inflight_downloads: dict[str, asyncio.Task] = dict()
+
 
-ei_img_storage_bucket = global_config.ei_img_storage_bucket
-ei_img_storage_region = global_config.ei_img_storage_region
-ei_img_storage_id: str = global_config.ei_img_storage_id
-ei_img_storage_key: str = global_config.ei_img_storage_key
-cache_dir = global_config.cache_dir
+async def run_in_storage_pool(func, *args, **kwargs):
+    async with storage_inflight:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(storage_executor, partial(func, *args, **kwargs))
 
-cos_config = CosConfig(Region=ei_img_storage_region, SecretId=ei_img_storage_id, SecretKey=ei_img_storage_key)
-cos_client = CosS3Client(cos_config)
 
-async def ei_img_storage_upload(filename:str, filebytes:bytes):
+def ei_img_storage_url(filename: str) -> str:
+    return storage_backend.url(filename)
+
+
+async def ei_img_storage_upload(filename:str, filebytes:bytes) -> bool:
     # store to local first
-    with open(os.path.join(cache_dir, filename), "wb") as f:
-        f.write(filebytes)
-    # upload to cos
-    try:
-        response = cos_client.put_object(
-            Bucket=ei_img_storage_bucket,
-            Body=filebytes,
-            Key=filename,
-            EnableMD5=False
-        )
-    except CosServiceError as e:
-        print(e.get_error_code())
-        print(e.get_error_msg())
-        print(e.get_resource_location())
-        return False
-    except CosClientError as e:
-        print(e.get_error_code())
-        print(e.get_error_msg())
-        return False
-    return response
+    await cache_put(filename, filebytes)
+    return await run_in_storage_pool(storage_backend.put, filename, filebytes)
+
+async def _download_and_cache(filename: str):
+    image_bytes = await ei_img_storage_download_fallback(filename)
+    if image_bytes is not None:
+        await cache_put(filename, image_bytes)
+    return image_bytes
 
 async def ei_img_storage_download(filename:str):
-    # search filename in cache folder
-    filelist = os.listdir(cache_dir)
-    if filename in filelist:
-        image_bytes = open(os.path.join(cache_dir, filename), "rb")
-        return image_bytes.read()
-    else:
-        image_bytes = await ei_img_storage_download_fallback(filename)
-        with open(os.path.join(cache_dir, filename), "wb") as f:
-            f.write(image_bytes)
+    image_bytes = await cache_get(filename)
+    if image_bytes is not None:
         return image_bytes
+    task = inflight_downloads.get(filename)
+    if task is None:
+        task = asyncio.ensure_future(_download_and_cache(filename))
+        inflight_downloads[filename] = task
+        task.add_done_callback(lambda _: inflight_downloads.pop(filename, None))
+    # shielded so one cancelled caller does not abort the fetch the others are waiting on
+    return await asyncio.shield(task)
 
 
 async def ei_img_storage_download_fallback(filename:str):
-    try:
-        response = cos_client.get_object(
-            Bucket=ei_img_storage_bucket,
-            Key=filename
-        )
-    except CosServiceError as e:
-        print(e.get_error_code())
-        print(e.get_error_msg())
-        print(e.get_resource_location())
-        return None
-    except CosClientError as e:
-        print(e.get_error_code())
-        print(e.get_error_msg())
-        return None
-    image_bytes = response["Body"]
-    image_bytes = image_bytes.get_raw_stream().read()
-    return image_bytes
+    return await run_in_storage_pool(storage_backend.get, filename)
+
+async def ei_img_storage_exists(filename: str) -> bool:
+    return await run_in_storage_pool(storage_backend.exists, filename)
+
+async def ei_img_storage_delete(filename:str) -> bool:
+    result = await run_in_storage_pool(storage_backend.delete, filename)
+    if result:
+        await cache_remove(filename)
+    return result
+
 
-async def ei_img_storage_delete(filename:str):
-    try:
-        response = cos_client.delete_object(
-            Bucket=ei_img_storage_bucket,
-            Key=filename
-        )
-    except CosServiceError as e:
-        print(e.get_error_code())
-        print(e.get_error_msg())
-        print(e.get_resource_location())
-        return None
-    except CosClientError as e:
-        print(e.get_error_code())
-        print(e.get_error_msg())
-        return None
-    filelist = os.listdir(cache_dir)
-    if filename in filelist:
-        os.remove(os.path.join(cache_dir, filename))
-    return response
\ No newline at end of file
+async def ei_img_storage_delete_many(filenames: list[str]) -> dict[str, bool]:
+    result = await run_in_storage_pool(storage_backend.delete_many, filenames)
+    for filename, deleted in result.items():
+        if deleted:
+            await cache_remove(filename)
+    return result
@@ -0,0 +1,155 @@
+import os
+import tempfile
+
+# this module must stay free of nonebot and plugin imports, scripts/bench_storage.py loads it standalone
+
+# blocking object store interface, storage.py runs every call in its worker pool
+class StorageBackend:
+    name = "base"
+
+    def put(self, key: str, data: bytes) -> bool:
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def delete_many(self, keys: list[str]) -> dict[str, bool]:
+        return {key: self.delete(key) for key in keys}
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def url(self, key: str) -> str:
+        raise NotImplementedError
+
+
+class CosStorageBackend(StorageBackend):
+    name = "cos"
+
+    def __init__(self, bucket: str, region: str, secret_id: str, secret_key: str, pool_size: int = 8) -> None:
+        from qcloud_cos import CosConfig, CosS3Client
+        from qcloud_cos import CosServiceError, CosClientError
+
+        self.bucket = bucket
+        self.region = region
+        self.errors = (CosServiceError, CosClientError)
+        # one pooled http connection per worker thread, so transfers reuse keep-alive connections
+        config = CosConfig(Region=region, SecretId=secret_id, SecretKey=secret_key,
+                           PoolConnections=pool_size, PoolMaxSize=pool_size)
+        self.client = CosS3Client(config)
+
+    def _print_error(self, e) -> None:
+        print(e.get_error_code())
+        print(e.get_error_msg())
+        if hasattr(e, "get_resource_location"):
+            print(e.get_resource_location())
+
+    def put(self, key: str, data: bytes) -> bool:
+        try:
+            self.client.put_object(Bucket=self.bucket, Body=data, Key=key, EnableMD5=False)
+        except self.errors as e:
+            self._print_error(e)
+            return False
+        return True
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+            # the body is streamed, drain it here while still in the worker thread
+            return response["Body"].get_raw_stream().read()
+        except self.errors as e:
+            self._print_error(e)
+            return None
+
+    def delete(self, key: str) -> bool:
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=key)
+        except self.errors as e:
+            self._print_error(e)
+            return False
+        return True
+
+    def delete_many(self, keys: list[str]) -> dict[str, bool]:
+        result = {key: False for key in keys}
+        # multi-object delete accepts at most 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            chunk = keys[i:i + 1000]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={
+                        "Object": [{"Key": key} for key in chunk],
+                        "Quiet": "false"
+                    }
+                )
+            except self.errors as e:
+                self._print_error(e)
+                continue
+            for deleted in response.get("Deleted", []):
+                result[deleted["Key"]] = True
+            for error in response.get("Error", []):
+                print(f"{error['Key']}: {error['Code']} {error['Message']}")
+        return result
+
+    def exists(self, key: str) -> bool:
+        try:
+            return self.client.object_exists(Bucket=self.bucket, Key=key)
+        except self.errors as e:
+            self._print_error(e)
+            return False
+
+    def url(self, key: str) -> str:
+        return f"https://{self.bucket}.cos.{self.region}.myqcloud.com/{key}"
+
+
+class LocalStorageBackend(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: str, url_prefix: str = "/api/image/") -> None:
+        self.root = root
+        self.url_prefix = url_prefix
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        key = os.path.normpath(key)
+        if key.startswith("..") or os.path.isabs(key):
+            raise ValueError(f"invalid storage key: {key}")
+        return os.path.join(self.root, key)
+
+    def put(self, key: str, data: bytes) -> bool:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def url(self, key: str) -> str:
+        return self.url_prefix + key
@@ -0,0 +1,100 @@
+import asyncio
+from io import BytesIO
+
+from PIL import Image, UnidentifiedImageError
+from nonebot.log import logger
+
+from .consts import global_config
+from .storage import ei_img_storage_upload, ei_img_storage_download, ei_img_storage_exists, ei_img_storage_url
+
+ei_thumbnail_widths: list[int] = getattr(global_config, "ei_thumbnail_widths", [240, 480])
+ei_thumbnail_format: str = getattr(global_config, "ei_thumbnail_format", "webp")
+
+# thumbnail keys known to exist in storage, so each one is only checked once per process
+known_thumbnails: set[str] = set()
+# image_hash -> generation in flight, the api and ingest never render the same image twice at once
+inflight_thumbnails: dict[str, asyncio.Task] = dict()
+
+
+def thumbnail_key(image_hash: str, width: int) -> str:
+    # flat key next to the original so it shares the cache shard of its hash
+    ext = "jpg" if ei_thumbnail_format == "jpeg" else ei_thumbnail_format
+    return f"{image_hash}_{width}w.{ext}"
+
+
+def thumbnail_keys(image_hash: str) -> list[str]:
+    return [thumbnail_key(image_hash, width) for width in ei_thumbnail_widths]
+
+
+def _render_thumbnails(image_bytes: bytes) -> dict[int, bytes]:
+    image = Image.open(BytesIO(image_bytes))
+    image.load()
+    if ei_thumbnail_format == "jpeg":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    rendered = dict()
+    for width in ei_thumbnail_widths:
+        if image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+        else:
+            resized = image
+        output = BytesIO()
+        resized.save(output, format=ei_thumbnail_format.upper(), quality=80)
+        rendered[width] = output.getvalue()
+    return rendered
+
+
+async def generate_thumbnails(image_hash: str, image_bytes: bytes) -> bool:
+    try:
+        rendered = await asyncio.to_thread(_render_thumbnails, image_bytes)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.warning(f"Failed to render thumbnails for {image_hash}: {e}")
+        return False
+    keys = {width: thumbnail_key(image_hash, width) for width in rendered}
+    results = await asyncio.gather(*[ei_img_storage_upload(keys[width], data) for width, data in rendered.items()])
+    for key, ok in zip(keys.values(), results):
+        if ok:
+            known_thumbnails.add(key)
+    return all(results)
+
+
+async def _ensure_thumbnails(image_hash: str, image_ext: str) -> bool:
+    missing = [key for key in thumbnail_keys(image_hash) if key not in known_thumbnails]
+    exists = await asyncio.gather(*[ei_img_storage_exists(key) for key in missing])
+    for key, ok in zip(missing, exists):
+        if ok:
+            known_thumbnails.add(key)
+    if all(exists):
+        return True
+    image_bytes = await ei_img_storage_download(f"{image_hash}.{image_ext}")
+    if image_bytes is None:
+        return False
+    logger.info(f"Generating missing thumbnails for {image_hash}")
+    return await generate_thumbnails(image_hash, image_bytes)
+
+
+async def ensure_thumbnails(image_hash: str, image_ext: str) -> bool:
+    if all(key in known_thumbnails for key in thumbnail_keys(image_hash)):
+        return True
+    task = inflight_thumbnails.get(image_hash)
+    if task is None:
+        task = asyncio.ensure_future(_ensure_thumbnails(image_hash, image_ext))
+        inflight_thumbnails[image_hash] = task
+        task.add_done_callback(lambda _: inflight_thumbnails.pop(image_hash, None))
+    return await asyncio.shield(task)
+
+
+def forget_thumbnails(image_hash: str) -> None:
+    for key in thumbnail_keys(image_hash):
+        known_thumbnails.discard(key)
+
+
+async def get_image_urls(image_hash: str, image_ext: str) -> dict:
+    original_url = ei_img_storage_url(f"{image_hash}.{image_ext}")
+    urls = {"img": original_url, "original": original_url, "thumbnails": {}}
+    if await ensure_thumbnails(image_hash, image_ext):
+        urls["thumbnails"] = {str(width): ei_img_storage_url(thumbnail_key(image_hash, width))
+                              for width in ei_thumbnail_widths}
+    return urls
@@ -1,4 +1,4 @@
-import os
+import asyncio
 import random
 import re
 from io import BytesIO
@@ -14,20 +14,29 @@ from nonebot.log import logger
 from PIL import Image, ImageDraw
 import base64
 
-from .data_es import find_similar_idioms_by_ocr_text, search_idiom as es_search_idiom, add_idiom as es_add_idiom
-from .data_mongo import get_catalogue_by_image_hash, get_comment_by_image_hash, get_idiom_by_catalogue, get_idiom_by_comment, add_idiom, get_ocr_text_by_image_hash
+from .data_es import find_similar_idioms_by_ocr_texts, search_idiom as es_search_idiom, add_idiom as es_add_idiom
+from .data_es import delete_idioms_by_image_hashes as es_delete_idioms_by_image_hashes
+from .data_mongo import add_idiom, get_idioms_by_catalogue_and_comment
 from .data_mongo import check_image_hash_exists, check_ocr_text_exists
-from .data_mongo import get_idiom_by_image_hash, get_ext_by_image_hash
 from .data_mongo import get_full_hash_by_prefix
+from .hash_index import shortest_unique_prefix
+from . import ocr_lsh
+from . import phash
+from .phash import image_phash as compute_image_phash
+from .data_mongo import get_idioms_by_prefixes, delete_idioms_by_image_hashes
 from .data_mongo import get_gm_info, set_gm_info
-from .storage import ei_img_storage_upload, ei_img_storage_download
+from .data_mongo import IdiomRepository
+from .storage import ei_img_storage_upload, ei_img_storage_download, ei_img_storage_delete_many
+from .thumbnail import generate_thumbnails, thumbnail_keys, forget_thumbnails
 from .ocr import get_ocr_text_cloud, get_ocr_text_local
-from .cat_checker import ep_alias_to_id, id_to_ep_alias
+from .cat_checker import ep_alias_to_id, ids_to_ep_aliases
 from .exceptions import HashPrefixNotFoundError, HashPrefixConflictError
 
 
 from .data_mongo import check_image_hash_exists
 
+from .data_redis import record_search
+from .query_cache import query_cache_key, cached_query
 from .consts import global_config, shanghai_tz
 
 ellye_gid = global_config.ellye_gid
@@ -40,7 +49,7 @@ tag_pat = re.compile(r"^#[^#]*$")
 
 
 async def hash_shortener(base16_str: str) -> str:
-    return base16_str[:6].upper()
+    return shortest_unique_prefix(base16_str).upper()
 
 
 async def hash_extender(base16_str: str, gid: str) -> str:
@@ -54,44 +63,101 @@ async def hash_extender(base16_str: str, gid: str) -> str:
         raise HashPrefixConflictError(base16_str, hash_list, gid)
 
 
+def _dedup_score_threshold(ocr_text: str) -> int:
+    ocr_text_length = len(ocr_text)
+    match ocr_text_length:
+        case _ if ocr_text_length < 10:
+            return 8
+        case _ if ocr_text_length < 30:
+            return 16
+        case _:
+            return 32
+
+
 async def check_dedup(image_hashes: list[str], upload_ok_quote: str, ellye_gid: str) -> Message:
     duplicate_quote = ""
-    for image_hash in image_hashes:
-        image_hash = await hash_extender(image_hash, ellye_gid)
-        try:
-            final_ocr_text = await get_ocr_text_by_image_hash(image_hash)
-        except TypeError:
-            continue
-        final_ocr_text = " ".join(final_ocr_text)
-        ocr_text_length = len(final_ocr_text)
-        match ocr_text_length:
-            case _ if ocr_text_length < 10:
-                score_threshold = 8
-            case _ if ocr_text_length < 30:
-                score_threshold = 16
-            case _:
-                score_threshold = 32
-        dedup_result = await find_similar_idioms_by_ocr_text(final_ocr_text)
-        try:
-            duplicate_idiom_hash = dedup_result["hits"]["hits"][0]["_source"]["image_hash"]
-            score = dedup_result["hits"]["hits"][0]["_score"]
-            if image_hash == duplicate_idiom_hash:
-                duplicate_idiom_hash = dedup_result["hits"]["hits"][1]["_source"]["image_hash"]
-                score = dedup_result["hits"]["hits"][1]["_score"]
-        except IndexError:
+    image_hashes = [await hash_extender(image_hash, ellye_gid) for image_hash in image_hashes]
+    repo = IdiomRepository(projection={"_id": 0, "image_hash": 1, "image_ext": 1, "ocr_text": 1})
+    records = await repo.get_many(image_hashes)
+    ocr_texts = {image_hash: " ".join(records[image_hash]["ocr_text"]) for image_hash in image_hashes
+                 if records[image_hash] is not None and records[image_hash]["ocr_text"]}
+    # image_hash -> (duplicate image_hash, why it counts as one)
+    duplicates: dict[str, tuple[str, str]] = dict()
+    if ocr_lsh.ei_dedup_lsh and ocr_lsh.ocr_lsh_loaded:
+        signatures = await asyncio.to_thread(ocr_lsh.minhash_many, [records[image_hash]["ocr_text"] for image_hash in ocr_texts])
+        for image_hash, signature in zip(ocr_texts, signatures):
+            candidates = ocr_lsh.find_similar(signature, exclude=image_hash)
+            if candidates:
+                duplicate_idiom_hash, similarity = candidates[0]
+                duplicates[image_hash] = (duplicate_idiom_hash, f"相似度：{similarity:.2f} ≥ {ocr_lsh.ei_dedup_lsh_threshold}")
+    pending = [image_hash for image_hash in ocr_texts if image_hash not in duplicates]
+    dedup_results = await find_similar_idioms_by_ocr_texts([ocr_texts[image_hash] for image_hash in pending])
+    for image_hash, dedup_result in zip(pending, dedup_results):
+        hits = [hit for hit in dedup_result["hits"]["hits"] if hit["_source"]["image_hash"] != image_hash]
+        if not hits:
             continue
+        score_threshold = _dedup_score_threshold(ocr_texts[image_hash])
+        score = hits[0]["_score"]
         if score > score_threshold:
-            duplicate_idiom_id = await hash_shortener(duplicate_idiom_hash)
-            duplicate_quote += f"\n{await hash_shortener(image_hash)} 似乎与已有怡言 {duplicate_idiom_id} "
-            duplicate_idiom_ext = await get_ext_by_image_hash(duplicate_idiom_hash)
-            duplicate_quote += MessageSegment.image(await ei_img_storage_download(duplicate_idiom_hash+"."+duplicate_idiom_ext))
-            duplicate_quote += f"重复，分数：{score} > {score_threshold}。"
+            duplicates[image_hash] = (hits[0]["_source"]["image_hash"], f"分数：{score} > {score_threshold}")
+    if not duplicates:
+        return upload_ok_quote
+
+    duplicate_records = await repo.get_many([duplicate for duplicate, _ in duplicates.values()])
+    found = [image_hash for image_hash in image_hashes
+             if image_hash in duplicates and duplicate_records[duplicates[image_hash][0]] is not None]
+    found = list(dict.fromkeys(found))
+    duplicate_images = await asyncio.gather(*[
+        ei_img_storage_download(f"{duplicates[image_hash][0]}.{duplicate_records[duplicates[image_hash][0]]['image_ext']}")
+        for image_hash in found
+    ])
+    for image_hash, duplicate_image in zip(found, duplicate_images):
+        duplicate_idiom_hash, reason = duplicates[image_hash]
+        duplicate_idiom_id = await hash_shortener(duplicate_idiom_hash)
+        duplicate_quote += f"\n{await hash_shortener(image_hash)} 似乎与已有怡言 {duplicate_idiom_id} "
+        duplicate_quote += MessageSegment.image(duplicate_image)
+        duplicate_quote += f"重复，{reason}。"
     if duplicate_quote:
         duplicate_quote = "\n警告：" + duplicate_quote
         upload_ok_quote += duplicate_quote
     return upload_ok_quote
 
 
+async def delete_idioms(image_ids: list[str]) -> dict[str, dict]:
+    # resolve every ID with one query, then delete from cos, mongo and es in one request each
+    image_ids = list(dict.fromkeys(image_id.lower() for image_id in image_ids if image_id))
+    report = dict()
+    if not image_ids:
+        return report
+    records = await get_idioms_by_prefixes(image_ids)
+    targets = dict()
+    for image_id in image_ids:
+        matched = [record for record in records if record["image_hash"].startswith(image_id)]
+        if len(matched) == 0:
+            report[image_id] = {"status": "not_found"}
+        elif len(matched) > 1:
+            report[image_id] = {"status": "conflict", "candidates": [record["image_hash"] for record in matched]}
+        else:
+            record = matched[0]
+            targets[image_id] = record
+            report[image_id] = {"status": "deleted", "image_hash": record["image_hash"]}
+    if not targets:
+        return report
+
+    filenames = {image_id: f"{record['image_hash']}.{record['image_ext']}" for image_id, record in targets.items()}
+    target_hashes = list({record["image_hash"] for record in targets.values()})
+    derivative_keys = [key for image_hash in target_hashes for key in thumbnail_keys(image_hash)]
+    storage_result = await ei_img_storage_delete_many(list(set(filenames.values())) + derivative_keys)
+    for image_hash in target_hashes:
+        forget_thumbnails(image_hash)
+    await delete_idioms_by_image_hashes(target_hashes)
+    await es_delete_idioms_by_image_hashes(target_hashes)
+    for image_id, filename in filenames.items():
+        if not storage_result.get(filename):
+            report[image_id]["status"] = "storage_failed"
+    return report
+
+
 async def download_image_from_qq(url):
     r = await client.get(url, timeout=10)
     return r.content
@@ -230,11 +296,12 @@ async def ei_argparser(message: Message | list, write_default_cat = True) -> dic
     return arg_result
 
 
-async def upload_image(matcher, image_contents: list[bytes], caption: list[str], uploader_info: dict, under_review: bool, comment: list[str], catalogue: list[str]):
+async def upload_image(matcher, image_contents: list[bytes], caption: list[str], uploader_info: dict, under_review: bool, comment: list[str], catalogue: list[str], es_refresh: bool | str | None = None):
     image_count = 0
     filename_list = list()
     large_image_list = list()
     exist_image_list = list()
+    near_duplicate_list = list()
     no_ocr_content_list = list()
     for image_content in image_contents:
         image_count += 1
@@ -245,6 +312,15 @@ async def upload_image(matcher, image_contents: list[bytes], caption: list[str],
         if await check_image_hash_exists(image_hash):
             exist_image_list.append(image_count)
             continue
+        # recompressed or rescaled copies of an existing idiom are caught here, before the paid OCR call
+        # whitelisted uploads skip review and this check alike, so a look-alike they mean to add still goes in
+        image_phash = await asyncio.to_thread(compute_image_phash, image_content)
+        if under_review and phash.ei_phash_dedup and phash.phash_index_loaded:
+            near_duplicates = phash.find_near_duplicates(image_phash)
+            if near_duplicates:
+                logger.info(f"{image_hash} is a near-duplicate of {near_duplicates[0][0]}, distance {near_duplicates[0][1]}")
+                near_duplicate_list.append(f"{image_count}（{await hash_shortener(near_duplicates[0][0])}）")
+                continue
 
         # if not under_review:
         #     ocr_result = await get_ocr_text_cloud(image_content)
@@ -264,11 +340,9 @@ async def upload_image(matcher, image_contents: list[bytes], caption: list[str],
         filename_list.append(filename)
 
         await ei_img_storage_upload(filename, image_content)
-        # save bytes to local file
-        with open(os.path.join(global_config.cache_dir, filename), "wb") as f:
-            f.write(image_content)
-        await add_idiom(tags=caption, image_hash=image_hash, image_ext=file_format, ocr_text=ocr_result, uploader_info=uploader_info, under_review=under_review, comment=comment, catalogue=catalogue)
-        await es_add_idiom(tags=caption, image_hash=image_hash, ocr_text=ocr_result, under_review=under_review)
+        await generate_thumbnails(image_hash, image_content)
+        await add_idiom(tags=caption, image_hash=image_hash, image_ext=file_format, ocr_text=ocr_result, uploader_info=uploader_info, under_review=under_review, comment=comment, catalogue=catalogue, image_phash=image_phash)
+        await es_add_idiom(tags=caption, image_hash=image_hash, ocr_text=ocr_result, under_review=under_review, comment=comment, catalogue=catalogue, refresh=es_refresh)
         if caption:
             logger.info(f"Uploaded {image_hash} with tags {caption}")
         else:
@@ -278,6 +352,8 @@ async def upload_image(matcher, image_contents: list[bytes], caption: list[str],
         warning_text += f"图片{large_image_list}过大，跳过上传。\n"
     if len(exist_image_list) > 0:
         warning_text += f"图片{exist_image_list}已存在，跳过上传。\n"
+    if len(near_duplicate_list) > 0:
+        warning_text += f"图片{'、'.join(near_duplicate_list)}与括号内的已有怡言相似，跳过上传。\n"
     if len(no_ocr_content_list) > 0 and not caption:
         warning_text += f"图片{no_ocr_content_list}无标签且未识别到文字，跳过上传。\n"
     if warning_text != "":
@@ -359,13 +435,38 @@ async def upload_to_telegram(matcher, reply_seg, image_url_list: list[str], capt
     await matcher.finish(reply_seg + upload_ok_quote)
 
 
-def common_member(a, b):
-    a_set = set(a)
-    b_set = set(b)
-    if (a_set & b_set):
-        return True
-    else:
-        return False
+async def find_idioms(keyword: str, cat_id_list: list[str], com_list: list[str], limit: int) -> list[dict]:
+    # approved idioms for a parsed 查询 as plain data, so the result can sit in the query cache
+    if not keyword:
+        # 无关键词，按照分类/备注搜索
+        if not (cat_id_list or com_list):
+            return []
+        idiom_list = await get_idioms_by_catalogue_and_comment(cat_id_list, com_list, limit)
+        return [{**idiom, "score": None} for idiom in idiom_list[:limit]]
+
+    # 按照关键词搜索，审核状态、分类和备注在ES中筛选
+    result = await es_search_idiom(keyword, catalogue=cat_id_list, comment=com_list,
+                                   approved_only=True, size=limit, min_score=1)
+    result_hits = result["hits"]["hits"]
+    if not result_hits:
+        return []
+    repo = IdiomRepository()
+    records = await repo.get_many([res["_source"]["image_hash"] for res in result_hits])
+    idiom_list = list()
+    for res in result_hits:
+        mongo_res = records[res["_source"]["image_hash"]]
+        # mongo holds the review status of record, an ES document that lags behind must not leak it
+        if mongo_res is None or mongo_res["under_review"]:
+            continue
+        idiom_list.append({
+            "image_hash": mongo_res["image_hash"],
+            "image_ext": mongo_res["image_ext"],
+            "tags": mongo_res["tags"],
+            "catalogue": mongo_res["catalogue"],
+            "comment": mongo_res["comment"],
+            "score": res["_score"]
+        })
+    return idiom_list
 
 
 async def get_idiom_result(keyword: str, limit: int):
@@ -376,96 +477,34 @@ async def get_idiom_result(keyword: str, limit: int):
     keyword = args["tag"]
     keyword = "".join(keyword)
 
-    idiom_list = list()
-    limit_count = 0
-    if not keyword:
-        # 无关键词，按照分类/备注搜索
-        result_text = ""
-        if cat_id_list and com_list:
-            cat_res_list = list()
-            for cat_id in cat_id_list:
-                cat_res_list.extend(list(await get_idiom_by_catalogue(cat_id)))
-
-            com_res_list = list()
-            for com in com_list:
-                com_res_list.extend(list(await get_idiom_by_comment(com)))
-
-            idiom_list = [
-                idiom for idiom in cat_res_list if idiom in com_res_list]
-        elif cat_id_list:
-            for cat_id in cat_id_list:
-                idiom_list.extend(list(await get_idiom_by_catalogue(cat_id)))
-        elif com_list:
-            for com in com_list:
-                idiom_list.extend(list(await get_idiom_by_comment(com)))
-
-        for res in idiom_list:
-            filename = f"{res['image_hash']}.{res['image_ext']}"
-            image_bytes = await ei_img_storage_download(filename)
-            img_id = await hash_shortener(res['image_hash'])
-            result_text += MessageSegment.image(BytesIO(image_bytes))
+    if keyword:
+        record_search(keyword)
+    key = query_cache_key("查询", keyword, cat_id_list, com_list, limit)
+    idiom_list = await cached_query(key, lambda: find_idioms(keyword, cat_id_list, com_list, limit))
+
+    result_text = ""
+    for res in idiom_list:
+        filename = f"{res['image_hash']}.{res['image_ext']}"
+        image_bytes = await ei_img_storage_download(filename)
+        img_id = await hash_shortener(res['image_hash'])
+        result_text += MessageSegment.image(BytesIO(image_bytes))
+        if res["score"] is None:
             result_text += f"ID: {img_id}\n"
             if len(res["tags"]) > 0:
                 result_text += f"标签：{' '.join(res['tags'])}\n"
             if len(res["catalogue"]) > 0:
-                cat_name = list()
-                for cat in res["catalogue"]:
-                    cat_name.append(await id_to_ep_alias(cat))
+                cat_name = await ids_to_ep_aliases(res["catalogue"])
                 result_text += f"分类：{' '.join(cat_name)}\n"
             if len(res["comment"]) > 0:
                 result_text += f"备注：{' '.join(res['comment'])}\n"
-            limit_count += 1
-            if limit_count >= limit:
-                break
-        return result_text, limit_count
-
-    else:
-        # 按照关键词搜索并筛选
-        result = await es_search_idiom(keyword)
-        if len(result["hits"]["total"]) == 0:
-            return None, 0
-        result_text = ""
-        result_hits = result["hits"]["hits"]
-        result_scores = [0]
-        for res in result_hits:
-            if res["_score"] < 1:
-                logger.info(f"Score too low: {res['_score']}")
-                continue
-            
-            if com_list:
-                mg_res = await get_comment_by_image_hash(res["_source"]["image_hash"])
-                if not common_member(com_list, mg_res):
-                    logger.info(f"Comment not match: {mg_res}")
-                    continue
-            if cat_id_list:
-                mg_res = await get_catalogue_by_image_hash(res["_source"]["image_hash"])
-                if not common_member(cat_id_list, mg_res):
-                    logger.info(f"Catalogue not match: {mg_res}")
-                    continue
-
-            # if len(result_scores) > 1 and result_scores[-1] - res["_score"] > 5:
-            #     result_text += "后续结果相关性差距过高，放弃输出。"
-            #     break
-            limit_count += 1
-            mongo_res = await get_idiom_by_image_hash(res['_source']['image_hash'])
-            if mongo_res["under_review"]:
-                logger.info(f"Image under review: {mongo_res['image_hash']}")
-                continue
-            filename = f"{mongo_res['image_hash']}.{mongo_res['image_ext']}"
-            image_bytes = await ei_img_storage_download(filename)
-            img_id = await hash_shortener(mongo_res['image_hash'])
-            result_text += MessageSegment.image(BytesIO(image_bytes))
-            result_text += f"相关性：{res['_score']}\n"
+        else:
+            result_text += f"相关性：{res['score']}\n"
             result_text += f"ID: {img_id}\n"
-            if len(res["_source"]["tags"]) > 0:
-                result_text += f"标签：{' '.join(mongo_res['tags'])}\n"
+            if len(res["tags"]) > 0:
+                result_text += f"标签：{' '.join(res['tags'])}\n"
             else:
                 result_text += "来源：文字OCR\n"
-            if limit_count >= limit:
-                logger.info("Limit reached")
-                break
-            result_scores.append(res["_score"])
-        return result_text, limit_count
+    return result_text, len(idiom_list)
 
 
 async def message_striper(msg: Message):
@@ -0,0 +1,67 @@
+# Copies the filter fields (under_review, catalogue, comment) from Mongo onto the
+# ES documents, so filtered searches also match idioms indexed before those
+# fields were. Needs documents keyed by image_hash, run migrate_es_ids.py first.
+#
+#   python scripts/backfill_es_filters.py
+#
+# Reads the same .env as the bot. Safe to run again, every document is just
+# overwritten with the current Mongo values.
+import asyncio
+import os
+import sys
+
+import nonebot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+nonebot.init()
+
+from elasticsearch.helpers import async_bulk  # noqa: E402
+
+from nonebot_plugin_ellyesidiom.data_es import es, es_index, ensure_es_mapping  # noqa: E402
+from nonebot_plugin_ellyesidiom.data_mongo import idioms_data  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+async def main() -> int:
+    await ensure_es_mapping()
+    projection = {"_id": 0, "image_hash": 1, "under_review": 1, "comment": 1, "catalogue": 1}
+    updated = 0
+    failed = 0
+    actions = list()
+    async for doc in idioms_data.find({}, projection):
+        actions.append({
+            "_op_type": "update",
+            "_index": es_index,
+            "_id": doc["image_hash"],
+            "doc": {
+                "under_review": doc.get("under_review", False),
+                "comment": doc.get("comment", []),
+                "catalogue": doc.get("catalogue", [])
+            }
+        })
+        if len(actions) >= BATCH_SIZE:
+            success, errors = await async_bulk(es, actions, raise_on_error=False)
+            updated += success
+            failed += len(errors)
+            actions = list()
+            print(f"  {updated} updated, {failed} failed")
+    if actions:
+        success, errors = await async_bulk(es, actions, raise_on_error=False)
+        updated += success
+        failed += len(errors)
+    await es.indices.refresh(index=es_index)
+    print(f"{updated} updated, {failed} failed")
+    return 1 if failed else 0
+
+
+async def run() -> int:
+    try:
+        return await main()
+    finally:
+        await es.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run()))
@@ -0,0 +1,82 @@
+# Storage backend throughput benchmark.
+#
+#   python scripts/bench_storage.py --backend local --root /tmp/ei_bench
+#   EI_COS_BUCKET=... EI_COS_REGION=... EI_COS_ID=... EI_COS_KEY=... python scripts/bench_storage.py --backend cos
+#
+# Objects are random bytes at typical QQ screenshot sizes, transferred with the
+# same number of worker threads storage.py uses in the bot.
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nonebot_plugin_ellyesidiom"))
+
+from storage_backends import StorageBackend, CosStorageBackend, LocalStorageBackend  # noqa: E402
+
+IMAGE_SIZES = {
+    "thumb 60KB": 60 * 1024,
+    "screenshot 300KB": 300 * 1024,
+    "long screenshot 1.5MB": 1536 * 1024,
+    "max 5MB": 5 * 1024 * 1024,
+}
+
+
+def create_backends(names: list[str], root: str, workers: int) -> list[StorageBackend]:
+    backends = list()
+    for name in names:
+        match name:
+            case "local":
+                backends.append(LocalStorageBackend(root))
+            case "cos":
+                backends.append(CosStorageBackend(os.environ["EI_COS_BUCKET"], os.environ["EI_COS_REGION"],
+                                                  os.environ["EI_COS_ID"], os.environ["EI_COS_KEY"],
+                                                  pool_size=workers))
+    return backends
+
+
+def timed(pool: ThreadPoolExecutor, func, keys: list[str], *args) -> float:
+    start = time.perf_counter()
+    results = list(pool.map(lambda key: func(key, *args), keys))
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for result in results if result is False or result is None)
+    if failed:
+        print(f"    warning: {failed} of {len(keys)} operations failed")
+    return elapsed
+
+
+def bench_backend(backend: StorageBackend, count: int, workers: int) -> None:
+    print(f"== {backend.name} ({count} objects per size, {workers} workers)")
+    print(f"  {'size':<24}{'op':<8}{'ops/s':>10}{'MB/s':>10}")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for label, size in IMAGE_SIZES.items():
+            payload = os.urandom(size)
+            keys = [f"bench/{uuid.uuid4().hex}.png" for _ in range(count)]
+            megabytes = size * count / 1024 / 1024
+            for op, func, extra in (("put", backend.put, (payload,)),
+                                    ("get", backend.get, ()),
+                                    ("delete", backend.delete, ())):
+                elapsed = timed(pool, func, keys, *extra)
+                mb_per_s = f"{megabytes / elapsed:.1f}" if op != "delete" else "-"
+                print(f"  {label:<24}{op:<8}{count / elapsed:>10.1f}{mb_per_s:>10}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare upload, download and delete throughput of storage backends.")
+    parser.add_argument("--backend", choices=["local", "cos", "all"], default="local")
+    parser.add_argument("--root", default=None, help="directory for the local backend, a temp dir by default")
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    names = ["local", "cos"] if args.backend == "all" else [args.backend]
+    with tempfile.TemporaryDirectory(prefix="ei_bench_") as tmp_root:
+        for backend in create_backends(names, args.root or tmp_root, args.workers):
+            bench_backend(backend, args.count, args.workers)
+
+
+if __name__ == "__main__":
+    main()
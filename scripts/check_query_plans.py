@@ -0,0 +1,33 @@
+# Fails (exit status 1) if any data_mongo query pattern is answered by a collection scan.
+#
+#   python scripts/check_query_plans.py
+#
+# Reads the same .env as the bot. Indexes are ensured first, so this also
+# verifies that ensure_indexes() covers every pattern in query_patterns.
+import asyncio
+import os
+import sys
+
+import nonebot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+nonebot.init()
+
+from nonebot_plugin_ellyesidiom.data_mongo import ensure_indexes, check_query_plans  # noqa: E402
+
+
+async def main() -> int:
+    report = await ensure_indexes()
+    failed_indexes = [index for index in report if index["status"].startswith("failed")]
+    plans = await check_query_plans()
+    collscans = [name for name, stages in plans.items() if "COLLSCAN" in stages]
+    for name, stages in plans.items():
+        print(f"{'FAIL' if name in collscans else 'ok  '} {name}: {' > '.join(stages)}")
+    for index in failed_indexes:
+        print(f"FAIL index {index['collection']}.{index['index']}: {index['status']}")
+    return 1 if collscans or failed_indexes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
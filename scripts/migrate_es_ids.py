@@ -0,0 +1,173 @@
+# Reindexes the idiom ES index so every document is keyed by _id = image_hash,
+# then points es_index at the new index through an alias.
+#
+#   python scripts/migrate_es_ids.py --dry-run
+#   python scripts/migrate_es_ids.py
+#   python scripts/migrate_es_ids.py --delete-source
+#
+# When es_index is still a concrete index the alias can only take its name once
+# that index is gone, so this needs --delete-source. The original documents are
+# first copied unchanged into a backup index, which is never deleted here.
+#
+# Reads the same .env as the bot. Run it while the previous bot version is still
+# serving, it looks documents up by image_hash and keeps working against the old
+# index, then deploy the version that writes by _id once the alias is swapped.
+#
+# Searches keep hitting the old index until the swap. Writes made during the copy
+# are picked up by a second reindex pass, and the result is reconciled against
+# Mongo before the swap. Duplicate documents of one image collapse into one.
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import nonebot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+nonebot.init()
+
+from elasticsearch.helpers import async_bulk, async_scan  # noqa: E402
+
+from nonebot_plugin_ellyesidiom.data_es import es, es_index  # noqa: E402
+from nonebot_plugin_ellyesidiom.data_mongo import idioms_data  # noqa: E402
+
+KEY_BY_HASH = {"source": "ctx._id = ctx._source.image_hash", "lang": "painless"}
+
+
+async def resolve_source() -> tuple[str, bool]:
+    # es_index is either still a concrete index or already an alias from an earlier migration
+    if await es.indices.exists_alias(name=es_index):
+        aliased = list((await es.indices.get_alias(name=es_index)).keys())
+        if len(aliased) != 1:
+            raise SystemExit(f"alias {es_index} points at {aliased}, expected exactly one index")
+        return aliased[0], True
+    if not await es.indices.exists(index=es_index):
+        raise SystemExit(f"index {es_index} does not exist")
+    return es_index, False
+
+
+async def reindex(source: str, target: str, script: dict | None = KEY_BY_HASH) -> None:
+    response = await es.reindex(source={"index": source}, dest={"index": target, "op_type": "index"},
+                                script=script, conflicts="proceed", wait_for_completion=False)
+    task_id = response["task"]
+    while True:
+        task = await es.tasks.get(task_id=task_id)
+        status = task["task"]["status"]
+        print(f"  {status['created'] + status['updated']}/{status['total']} documents")
+        if task["completed"]:
+            failures = task.get("response", {}).get("failures", [])
+            if failures:
+                raise SystemExit(f"reindex failed: {failures[:5]}")
+            return
+        await asyncio.sleep(5)
+
+
+async def reconcile(target: str) -> tuple[int, int]:
+    es_hashes = set()
+    async for hit in async_scan(es, index=target, query={"query": {"match_all": {}}}, _source=False):
+        es_hashes.add(hit["_id"])
+    mongo_docs = dict()
+    projection = {"_id": 0, "image_hash": 1, "tags": 1, "ocr_text": 1, "under_review": 1, "comment": 1, "catalogue": 1}
+    async for doc in idioms_data.find({}, projection):
+        mongo_docs[doc["image_hash"]] = doc
+    missing = [mongo_docs[h] for h in mongo_docs.keys() - es_hashes]
+    extra = list(es_hashes - mongo_docs.keys())
+    actions = [{
+        "_op_type": "index",
+        "_index": target,
+        "_id": doc["image_hash"],
+        "_source": {
+            "image_hash": doc["image_hash"],
+            "tags": doc.get("tags", []),
+            "ocr_text": doc.get("ocr_text", []),
+            "under_review": doc.get("under_review", False),
+            "comment": doc.get("comment", []),
+            "catalogue": doc.get("catalogue", [])
+        }
+    } for doc in missing]
+    actions += [{"_op_type": "delete", "_index": target, "_id": h} for h in extra]
+    if actions:
+        await async_bulk(es, actions)
+    return len(missing), len(extra)
+
+
+async def main(dry_run: bool, delete_source: bool) -> int:
+    source, is_alias = await resolve_source()
+    suffix = time.strftime('%Y%m%d%H%M%S')
+    target = f"{es_index}_{suffix}"
+    backup = f"{es_index}_backup_{suffix}"
+    source_count = (await es.count(index=source))["count"]
+    print(f"{es_index} -> {source} ({'alias' if is_alias else 'concrete index'}), {source_count} documents")
+    print(f"new index: {target}")
+    if not is_alias:
+        print(f"backup of {source}: {backup}")
+        if not delete_source:
+            print(f"{source} is a concrete index and has to be dropped for the alias to take its name, "
+                  f"rerun with --delete-source to back it up and swap")
+            return 0 if dry_run else 1
+    if dry_run:
+        return 0
+
+    mappings = (await es.indices.get_mapping(index=source))[source]["mappings"]
+    # refreshing during the bulk copy only slows it down, it is restored before the swap
+    await es.indices.create(index=target, mappings=mappings, settings={"refresh_interval": "-1"})
+
+    print("copying documents")
+    await reindex(source, target)
+    print("copying writes made during the first pass")
+    await reindex(source, target)
+
+    await es.indices.put_settings(index=target, settings={"refresh_interval": None})
+    await es.indices.refresh(index=target)
+    missing, extra = await reconcile(target)
+    print(f"reconciled with mongo: {missing} indexed, {extra} deleted")
+
+    if not is_alias:
+        print(f"backing {source} up into {backup}")
+        await es.indices.create(index=backup, mappings=mappings)
+        await reindex(source, backup, script=None)
+        await es.indices.refresh(index=backup)
+        backup_count = (await es.count(index=backup))["count"]
+        source_count = (await es.count(index=source))["count"]
+        if backup_count < source_count:
+            raise SystemExit(f"backup has {backup_count} of {source_count} documents, {source} is left untouched")
+
+    # second pass right before the swap, for writes that landed during the first reconcile and the backup
+    await es.indices.refresh(index=target)
+    missing, extra = await reconcile(target)
+    print(f"reconciled with mongo again: {missing} indexed, {extra} deleted")
+    await es.indices.refresh(index=target)
+    target_count = (await es.count(index=target))["count"]
+    print(f"{target}: {target_count} documents")
+
+    if is_alias:
+        actions = [{"remove": {"index": source, "alias": es_index}}]
+    else:
+        # an alias cannot share its name with an index, the old index is dropped in the same atomic step
+        actions = [{"remove_index": {"index": source}}]
+    actions.append({"add": {"index": target, "alias": es_index}})
+    await es.indices.update_aliases(actions=actions)
+    print(f"alias {es_index} -> {target}")
+    if is_alias:
+        print(f"old index {source} is kept, delete it once the new one is verified")
+    else:
+        print(f"{source} was dropped, its documents are kept in {backup}")
+    return 0
+
+
+async def run(dry_run: bool, delete_source: bool) -> int:
+    try:
+        return await main(dry_run, delete_source)
+    finally:
+        await es.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Key ES idiom documents by image_hash")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be migrated")
+    parser.add_argument("--delete-source", action="store_true",
+                        help="allow dropping a concrete es_index after backing it up, needed for the alias swap")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.dry_run, args.delete_source)))